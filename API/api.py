@@ -6,10 +6,10 @@ api.py
 Created by Brian Whitman on 2010-06-16.
 Copyright (c) 2010 The Echo Nest Corporation. All rights reserved.
 """
-from __future__ import with_statement
 
 import web
 import fp
+import ingestqueue
 import re
 
 try:
@@ -21,15 +21,21 @@ except ImportError:
 # Very simple web facing API for FP dist
 
 urls = (
+    '/query_batch', 'query_batch',
     '/query', 'query',
     '/query?(.*)', 'query',
     '/ingest', 'ingest',
+    '/ingest_stream', 'ingest_stream',
+    '/ingest_status', 'ingest_status',
 )
 
+# Ingests are committed in batches, a flush at most every second
+_ingest_queue = ingestqueue.IngestQueue(max_docs=1000, max_delay=1.0)
+
 
 class ingest:
     def POST(self):
-        params = web.input(track_id="default", fp_code="", artist=None, release=None, track=None, length=None, codever=None)
+        params = web.input(track_id="default", fp_code="", artist=None, release=None, track=None, length=None, codever=None, wait=None)
         if params.track_id == "default":
             track_id = fp.new_track_id()
         else:
@@ -37,13 +43,9 @@ class ingest:
         if params.length is None or params.codever is None:
             return web.webapi.BadRequest()
         
-        # First see if this is a compressed code
-        if re.match('[A-Za-z\/\+\_\-]', params.fp_code) is not None:
-           code_string = fp.decode_code_string(params.fp_code)
-           if code_string is None:
-               return json.dumps({"track_id":track_id, "ok":False, "error":"cannot decode code string %s" % params.fp_code})
-        else:
-            code_string = params.fp_code
+        code_string = decode_fp_code(params.fp_code)
+        if code_string is None:
+            return json.dumps({"track_id":track_id, "ok":False, "error":"cannot decode code string %s" % params.fp_code})
 
         data = {"track_id": track_id, 
                 "fp": code_string,
@@ -52,10 +54,107 @@ class ingest:
         if params.artist: data["artist"] = params.artist
         if params.release: data["release"] = params.release
         if params.track: data["track"] = params.track
-        fp.ingest(data, do_commit=True, local=False)
+        try:
+            # Refuse what Solr won't take now, before it can sink a whole flush
+            ticket = _ingest_queue.submit(data)
+        except ValueError, e:
+            return json.dumps({"track_id":track_id, "ok":False, "error":str(e)})
+        if params.wait:
+            # Only answer once the track is committed (or its flush failed)
+            status = _ingest_queue.wait(ticket, timeout=60)
+        else:
+            status = _ingest_queue.status(ticket)
+        # "status" still says the track was accepted, as it did before ingests were queued
+        result = {"track_id": track_id, "status": "ok", "ticket": ticket, "ingest_status": status["status"]}
+        if "error" in status:
+            result["error"] = status["error"]
+        return json.dumps(result)
+
+
+def decode_fp_code(fp_code):
+    """ The Codes of a packed or plain code string, None if it can't be decoded """
+    # First see if this is a compressed code
+    if re.match('[A-Za-z\/\+\_\-]', fp_code) is not None:
+        return fp.decode_codes(fp_code)
+    try:
+        return fp.Codes.from_string(fp_code)
+    except ValueError:
+        return None
+
+
+# Fingerprints per write in /ingest_stream
+STREAM_BATCH = 500
+# Most errors /ingest_stream lists in its answer; it counts all of them
+MAX_STREAM_ERRORS = 100
+
+class ingest_stream:
+    """ Bulk ingest in one request. The body (chunked or not) is NDJSON, one
+        fingerprint per line with the fields fp.ingest takes; fp may be
+        packed like /ingest's fp_code. Lines are read and written to Solr
+        and the keystore STREAM_BATCH at a time, with one commit at the
+        end, so memory doesn't grow with the upload. Answers with the
+        counts of ingested and failed fingerprints and the first errors. """
+    def POST(self):
+        result = {"ok":True, "ingested":0, "failed":0, "errors":[]}
+        def failed(count, error, **where):
+            result["ok"] = False
+            result["failed"] += count
+            if len(result["errors"]) < MAX_STREAM_ERRORS:
+                where["error"] = error
+                result["errors"].append(where)
+        def write(batch, first, last):
+            try:
+                fp.ingest(batch, do_commit=False)
+            except Exception, e:
+                failed(len(batch), str(e), lines=[first, last])
+            else:
+                result["ingested"] += len(batch)
+
+        body = web.ctx.env["wsgi.input"]
+        batch = []
+        first = None
+        line_number = 0
+        for line in iter(body.readline, ""):
+            line_number += 1
+            if not line.strip():
+                continue
+            try:
+                fprint = json.loads(line)
+                if not isinstance(fprint, dict):
+                    raise ValueError("not a JSON object")
+                fp.check_fingerprint(fprint)
+                if isinstance(fprint["fp"], basestring):
+                    fprint["fp"] = decode_fp_code(fprint["fp"].encode("utf8"))
+                    if fprint["fp"] is None:
+                        raise ValueError("cannot decode code string")
+            except Exception, e:
+                failed(1, str(e), line=line_number)
+                continue
+            if first is None:
+                first = line_number
+            batch.append(fprint)
+            if len(batch) >= STREAM_BATCH:
+                write(batch, first, line_number)
+                (batch, first) = ([], None)
+        if batch:
+            write(batch, first, line_number)
+        if result["ingested"]:
+            fp.commit()
+        return json.dumps(result)
+
+
+class ingest_status:
+    """ The status of an /ingest ticket, or of the queue without one """
+    def GET(self):
+        params = web.input(ticket=None)
+        if params.ticket is None:
+            return json.dumps(_ingest_queue.stats())
+        try:
+            ticket = int(params.ticket)
+        except ValueError:
+            return web.webapi.BadRequest()
+        return json.dumps(_ingest_queue.status(ticket))
 
-        return json.dumps({"track_id":track_id, "status":"ok"})
-        
     
 class query:
     def POST(self):
@@ -64,8 +163,42 @@ class query:
     def GET(self):
         stuff = web.input(fp_code="")
         response = fp.best_match_for_query(stuff.fp_code)
-        return json.dumps({"ok":True, "query":stuff.fp_code, "message":response.message(), "match":response.match(), "score":response.score, \
-                        "qtime":response.qtime, "track_id":response.TRID, "total_time":response.total_time})
+        return json.dumps(query_result(stuff.fp_code, response))
+
+
+def query_result(fp_code, response):
+    return {"ok":True, "query":fp_code, "message":response.message(), "match":response.match(), "score":response.score, \
+            "qtime":response.qtime, "track_id":response.TRID, "total_time":response.total_time}
+
+
+# Most fp_codes a /query_batch request may have
+MAX_BATCH = 1000
+
+class query_batch:
+    """ Many queries in one request. The body is a JSON array of fp_codes,
+        or one JSON fp_code per line (NDJSON); either may also be objects
+        with an fp_code. The results are returned in order, in the same
+        format: {"ok":true, "results":[...]} or one result per line. """
+    def POST(self):
+        body = web.data().strip()
+        ndjson = not body.startswith("[")
+        try:
+            if ndjson:
+                items = [json.loads(line) for line in body.splitlines() if line.strip()]
+            else:
+                items = json.loads(body)
+            fp_codes = [item["fp_code"] if isinstance(item, dict) else item for item in items]
+        except (ValueError, KeyError, TypeError):
+            return web.webapi.BadRequest()
+        if len(fp_codes) > MAX_BATCH or not all(isinstance(c, basestring) for c in fp_codes):
+            return web.webapi.BadRequest()
+
+        responses = fp.best_match_for_queries(fp_codes)
+        results = [query_result(c, r) for (c, r) in zip(fp_codes, responses)]
+        if ndjson:
+            web.header("Content-Type", "application/x-ndjson")
+            return "".join(json.dumps(r) + "\n" for r in results)
+        return json.dumps({"ok":True, "results":results})
 
 
 application = web.application(urls, globals())#.wsgifunc()
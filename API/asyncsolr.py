@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+asyncsolr.py
+
+Non-blocking Solr queries for asyncore event loops. Requests are built and
+responses parsed by solr.SolrConnection, so a query takes the same
+arguments and gives the same Response as SolrConnection.query; only the
+HTTP exchange is different. Each query gets a keep-alive connection of its
+own (reused once it's done), so any number can be in flight at once:
+
+    >>> s = asyncsolr.AsyncSolr("http://localhost:8502/solr/fp")
+    >>> f = s.query("track_id:TRABC-0")
+    >>> asynctyrant.wait([f], map=s.map)
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import asyncore
+import socket
+import urllib
+
+import solr
+from asynctyrant import Future
+
+
+class AsyncSolr(object):
+    def __init__(self, url, map=None, pool_size=20):
+        """ A client for the Solr at url, keeping up to pool_size idle
+            connections. map is the asyncore socket map of the loop it runs on. """
+        if map is None:
+            map = {}
+        self.map = map
+        # Only used to build requests and parse responses; it never connects
+        self.connection = solr.SolrConnection(url)
+        self.pool_size = pool_size
+        self._idle = []
+
+    def query(self, q, fields=None, highlight=None, score=True, sort=None, **params):
+        """ A Future of the Response to a query. See SolrConnection.query. """
+        params = self.connection.query_params(q, fields, highlight, score, sort, **params)
+        body = urllib.urlencode(params, doseq=True)
+        path = self.connection.path + '/select' + self.connection.invariant
+        future = Future()
+        retries = [1]
+        def done(status, reason, data):
+            if status is None:
+                # A kept-alive connection can be closed by the server just
+                # as a request goes out; try once more on a new one
+                if retries[0]:
+                    retries[0] -= 1
+                    self._channel().request(path, body, self.connection.form_headers, done)
+                else:
+                    future.set_exception(socket.error(reason))
+                return
+            if status != 200:
+                future.set_exception(solr.SolrHTTPException(status, reason, data))
+                return
+            try:
+                response = self.connection.parse_select(data, params)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(response)
+        self._channel().request(path, body, self.connection.form_headers, done)
+        return future
+
+    def close(self):
+        for channel in self._idle:
+            channel.close()
+        self._idle = []
+
+    def _channel(self):
+        while self._idle:
+            channel = self._idle.pop()
+            if channel.socket is not None:
+                return channel
+        return _HTTPChannel(self, self.connection.host)
+
+    def _release(self, channel):
+        if len(self._idle) < self.pool_size:
+            self._idle.append(channel)
+        else:
+            channel.close()
+
+
+class _HTTPChannel(asyncore.dispatcher):
+    """ One HTTP/1.1 connection, running one request at a time """
+    def __init__(self, client, host):
+        asyncore.dispatcher.__init__(self, map=client.map)
+        self.client = client
+        (self.host, _, port) = host.partition(':')
+        self.port = int(port or 80)
+        self._done = None
+        self._out = ''
+        self._in = ''
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self.connect((self.host, self.port))
+
+    def request(self, path, body, headers, done):
+        """ POST body to path and call done(status, reason, body) """
+        lines = ['POST %s HTTP/1.1' % path, 'Host: %s' % self.client.connection.host,
+                 'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        self._out = '\r\n'.join(lines) + '\r\n\r\n' + body
+        self._in = ''
+        self._done = done
+
+    def writable(self):
+        return not self.connected or len(self._out) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self._in += data
+        self._finish(_parse_response(self._in, closed=False))
+
+    def handle_close(self):
+        # Responses without a length end when the connection does
+        if self._done is not None and self._in:
+            self._finish(_parse_response(self._in, closed=True))
+        self.close()
+
+    def _finish(self, response):
+        if response is None or self._done is None:
+            return
+        (status, reason, body, keep_alive) = response
+        done = self._done
+        self._done = None
+        self._in = ''
+        if keep_alive:
+            self.client._release(self)
+        else:
+            self.close()
+        done(status, reason, body)
+
+    def handle_error(self):
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+            self.socket = None
+        if self._done is not None:
+            done = self._done
+            self._done = None
+            done(None, "connection to %s:%d failed" % (self.host, self.port), None)
+
+
+def _parse_response(data, closed):
+    """ (status, reason, body, keep alive) of a complete HTTP response in
+        data, or None if more is needed """
+    end = data.find('\r\n\r\n')
+    if end < 0:
+        return None
+    head = data[:end].split('\r\n')
+    (version, status, reason) = (head[0].split(' ', 2) + [''])[:3]
+    headers = {}
+    for line in head[1:]:
+        (name, _, value) = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+    rest = data[end + 4:]
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = []
+        pos = 0
+        while True:
+            line_end = rest.find('\r\n', pos)
+            if line_end < 0:
+                return None
+            size = int(rest[pos:line_end].split(';')[0], 16)
+            if size == 0:
+                # The message ends with a blank line, after any trailers
+                if rest.find('\r\n\r\n', line_end) < 0:
+                    return None
+                break
+            if len(rest) < line_end + 2 + size + 2:
+                return None
+            body.append(rest[line_end + 2:line_end + 2 + size])
+            pos = line_end + 2 + size + 2
+        return (int(status), reason, ''.join(body), keep_alive)
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        if len(rest) < length:
+            return None
+        return (int(status), reason, rest[:length], keep_alive)
+    if not closed:
+        return None
+    return (int(status), reason, rest, False)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+asynctyrant.py
+
+A non-blocking Tokyo Tyrant client for asyncore event loops, with the same
+commands as pytyrant.PyTyrant. Each command returns a Future right away;
+the requests go out back to back on one connection and the replies, which
+Tyrant sends in order, resolve the futures as the loop reads them:
+
+    >>> t = asynctyrant.AsyncTyrant('127.0.0.1', 1978)
+    >>> f = t.multi_get(['TRABC-0', 'TRABC-1'])
+    >>> f.add_done_callback(lambda f: handle(f.result()))
+    >>> asyncore.loop(map=t.map)
+
+or, outside a loop, asynctyrant.wait([f]).
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import asyncore
+import socket
+import struct
+import time
+from collections import deque
+
+from pytyrant import C, DEFAULT_PORT, RDBMONOULOG, TyrantError, TyrantConnectionError, _t0, _t1, _t1M, _t1FN
+
+
+class Future(object):
+    """ The eventual result of a command, like concurrent.futures.Future
+        but resolved by the event loop rather than by another thread """
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("result isn't ready yet")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) when the future is done (now, if it already is) """
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def then(self, fn):
+        """ A Future of fn(result), or of the result of the Future fn returns.
+            An exception here or from fn fails the new Future instead. """
+        future = Future()
+        def done(f):
+            if f._exception is not None:
+                return future.set_exception(f._exception)
+            try:
+                result = fn(f._result)
+            except Exception, e:
+                return future.set_exception(e)
+            if isinstance(result, Future):
+                result.add_done_callback(lambda r: _chain(r, future))
+            else:
+                future.set_result(result)
+        self.add_done_callback(done)
+        return future
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        (callbacks, self._callbacks) = (self._callbacks, [])
+        for fn in callbacks:
+            fn(self)
+
+
+def resolved(result):
+    """ A Future that is already done, with result """
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def wait(futures, map=None, timeout=30.0):
+    """ Run the loop until all of futures are done, or for timeout seconds """
+    deadline = time.time() + timeout
+    while not all(f.done() for f in futures):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("waited %.1fs for Tyrant" % timeout)
+        asyncore.loop(timeout=min(0.05, remaining), map=map, count=1)
+
+
+class _Incomplete(Exception):
+    """ The reply hasn't been fully received yet """
+
+
+class _Reply(object):
+    """ Reads the fields of one reply from the receive buffer """
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+
+    def bytes(self, n):
+        if self.pos + n > len(self.buf):
+            raise _Incomplete()
+        self.pos += n
+        return str(self.buf[self.pos - n:self.pos])
+
+    def code(self):
+        return ord(self.bytes(1))
+
+    def len(self):
+        return struct.unpack('>I', self.bytes(4))[0]
+
+    def long(self):
+        return struct.unpack('>Q', self.bytes(8))[0]
+
+    def str(self):
+        return self.bytes(self.len())
+
+    def strs(self):
+        return [self.str() for i in xrange(self.len())]
+
+
+def _success(r):
+    code = r.code()
+    if code:
+        raise TyrantError(code)
+
+def _value(r):
+    _success(r)
+    return r.str()
+
+def _values(r):
+    code = r.code()
+    values = r.strs()
+    if code:
+        raise TyrantError(code)
+    return values
+
+def _long(r):
+    _success(r)
+    return r.long()
+
+
+class AsyncTyrant(asyncore.dispatcher):
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, map=None):
+        """ A client for the Tyrant at host:port. It connects when the first
+            command is sent, and again after the connection is lost. map is
+            the asyncore socket map of the loop it runs on. """
+        if map is None:
+            map = {}
+        asyncore.dispatcher.__init__(self, map=map)
+        self.map = map
+        self.address = (host, port)
+        self._out = bytearray()
+        self._in = bytearray()
+        self._pending = deque() # (parser, future) per command sent, in order
+
+    def get(self, key):
+        """ The value of key. Fails with KeyError if it's missing. """
+        future = Future()
+        self._command(_t1(C.get, key), _value, _KeyErrorFuture(key, future))
+        return future
+
+    def multi_get(self, keys, no_update_log=False):
+        """ The values of keys, None for missing ones """
+        keys = list(keys)
+        future = Future()
+        def done(f):
+            if f.exception() is not None:
+                return future.set_exception(f.exception())
+            rval = f.result()
+            d = dict((rval[i], rval[i + 1]) for i in xrange(0, len(rval), 2))
+            future.set_result(map(d.get, keys))
+        self._misc("getlist", no_update_log, keys).add_done_callback(done)
+        return future
+
+    def multi_set(self, items, no_update_log=False):
+        lst = []
+        for k, v in items:
+            lst.extend((k, v))
+        return self._misc("putlist", no_update_log, lst)
+
+    def multi_del(self, keys, no_update_log=False):
+        return self._misc("outlist", no_update_log, list(keys))
+
+    def prefix_keys(self, prefix, maxkeys=None):
+        """ Keys starting with prefix, at most maxkeys of them """
+        if maxkeys is not None:
+            future = Future()
+            self._command(_t1M(C.fwmkeys, prefix, maxkeys), _values, future)
+            return future
+        # Like PyTyrant, ask for as many keys as the database holds
+        future = Future()
+        def counted(f):
+            if f.exception() is not None:
+                return future.set_exception(f.exception())
+            self.prefix_keys(prefix, f.result()).add_done_callback(lambda f: _chain(f, future))
+        counter = Future()
+        counter.add_done_callback(counted)
+        self._command(_t0(C.rnum), _long, counter)
+        return future
+
+    def get_stats(self):
+        future = Future()
+        def done(f):
+            if f.exception() is not None:
+                return future.set_exception(f.exception())
+            future.set_result(dict(l.split('\t', 1) for l in f.result().splitlines() if l))
+        stat = Future()
+        stat.add_done_callback(done)
+        self._command(_t0(C.stat), _value, stat)
+        return future
+
+    def close(self):
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+            self.socket = None
+        self._fail(TyrantConnectionError('Connection closed'))
+
+    def _misc(self, func, no_update_log, args):
+        future = Future()
+        self._command(_t1FN(C.misc, func, no_update_log and RDBMONOULOG or 0, args), _values, future)
+        return future
+
+    def _command(self, request, parser, future):
+        if self.socket is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            self.connect(self.address)
+        for part in request:
+            self._out.extend(part)
+        self._pending.append((parser, future))
+
+    # asyncore callbacks
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return not self.connected or len(self._out) > 0
+
+    def readable(self):
+        return True
+
+    def handle_write(self):
+        sent = self.send(memoryview(self._out)[:65536])
+        del self._out[:sent]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self._in.extend(data)
+        # Resolve every reply that is complete, then drop them from the buffer
+        done = 0
+        while self._pending:
+            reply = _Reply(self._in, done)
+            (parser, future) = self._pending[0]
+            try:
+                result = parser(reply)
+            except _Incomplete:
+                break
+            except TyrantError, e:
+                (setter, value) = (future.set_exception, e)
+            else:
+                (setter, value) = (future.set_result, result)
+            self._pending.popleft()
+            done = reply.pos
+            setter(value)
+        del self._in[:done]
+        if self._in and not self._pending:
+            # Data nobody asked for: the connection is out of step
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.close()
+
+    def _fail(self, error):
+        pending = self._pending
+        self._pending = deque()
+        self._out = bytearray()
+        self._in = bytearray()
+        for (parser, future) in pending:
+            future.set_exception(error)
+
+
+class _KeyErrorFuture(object):
+    """ Passes results to future, turning Tyrant's error reply into KeyError """
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+
+    def set_result(self, result):
+        self.future.set_result(result)
+
+    def set_exception(self, exception):
+        if not isinstance(exception, TyrantConnectionError):
+            exception = KeyError(self.key)
+        self.future.set_exception(exception)
+
+
+def _chain(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+cache.py
+
+A small thread safe in-process cache with LRU eviction and an optional TTL,
+used by fp to avoid repeating round trips to Solr and Tyrant.
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=10000, ttl=None):
+        """ Hold at most maxsize entries. With ttl, entries expire ttl
+            seconds after they were put. """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation. A value computed from data read before
+        # an invalidation can be put with the generation from before it, and
+        # is then dropped instead of cached.
+        self.generation = 0
+        self._entries = OrderedDict() # key -> (expiry time, value), oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing, count=False) is not _missing
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                # Move it to the most recently used end
+                self._entries[key] = entry
+                if count:
+                    self.hits += 1
+                return entry[1]
+            if count:
+                self.misses += 1
+            return default
+
+    def put(self, key, value, generation=None, ttl=None):
+        """ Cache value under key. ttl, if given, is used for this entry
+            instead of the cache's. """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def hit_rate(self):
+        """ The fraction of gets that were hits """
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def stats(self):
+        return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hit_rate()}
+
+
+_missing = object()
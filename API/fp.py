@@ -6,14 +6,20 @@ fp.py
 Created by Brian Whitman on 2010-06-16.
 Copyright (c) 2010 The Echo Nest Corporation. All rights reserved.
 """
-from __future__ import with_statement
 import logging
 import solr
 import pickle
-from collections import defaultdict
-import zlib, base64, re, time, random, string, math
+import zlib, base64, re, time, random, string, math, hashlib
+import threading
+import copy
 import pytyrant
 import datetime
+import numpy
+import localindex
+import cache
+import hashset
+import asyncsolr
+import asynctyrant
 
 now = datetime.datetime.utcnow()
 IMPORTDATE = now.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -27,7 +33,32 @@ _fp_solr = solr.SolrConnectionPool("http://localhost:8502/solr/fp")
 _hexpoch = int(time.time() * 1000)
 logger = logging.getLogger(__name__)
 _tyrant_address = ['localhost', 1978]
+_tyrant_pool_size = 20
 _tyrant = None
+_tyrant_lock = threading.Lock()
+# Solr metadata by track id (without the segment number). Ingest and delete
+# invalidate it; the TTL bounds staleness from other processes' writes.
+_metadata_cache = cache.LRUCache(10000, ttl=600)
+# Responses of best_match_for_query by query digest, or None when off.
+# See set_query_cache.
+_query_cache = None
+# Recent no-match responses by query digest
+_negative_cache = cache.LRUCache(10000, ttl=30)
+# The hashes in the index, or None until load_hash_filter is called.
+# Queries with fewer than KNOWN_HASH_FRACTION of their codes in it can't
+# score the 5% of the query length a match needs, so don't go to Solr.
+_known_hashes = None
+KNOWN_HASH_FRACTION = 0.05
+# Batches concurrent queries' keystore and metadata fetches, or None when
+# off. See set_query_batching.
+_query_scheduler = None
+# Track ids per Solr query in metadata_for_track_ids, well under Solr's
+# default limit of 1024 boolean clauses
+METADATA_BATCH = 500
+# The stored fields metadata lookups give. Every segment of a track has the
+# same ones, so query results of any segment can fill the metadata cache.
+METADATA_FIELDS = "track_id,artist,release,track,length,codever,source,import_date"
+_METADATA_KEYS = frozenset(METADATA_FIELDS.split(","))
 
 class Response(object):
     # Response codes
@@ -59,48 +90,133 @@ class Response(object):
     
     def match(self):
         return self.TRID is not None
-     
 
-def inflate_code_string(s):
+
+class Codes(object):
+    """ A code string held as two parallel integer arrays, one of hash codes
+        and one of times. str() gives back the "code time code time ..."
+        string that Solr and the keystore use. All of the code handling
+        functions in this module take either form and return the form they
+        were given. """
+    def __init__(self, codes=None, times=None):
+        if codes is None:
+            codes = []
+        if times is None:
+            times = []
+        self.codes = numpy.asarray(codes, dtype=numpy.uint32)
+        self.times = numpy.asarray(times, dtype=numpy.int32)
+        assert(len(self.codes) == len(self.times))
+
+    @classmethod
+    def from_string(cls, code_string):
+        """ Parse a "code time code time ..." string. Raises ValueError for
+            anything else: a token that isn't an integer, an odd number of
+            them, or a value that doesn't fit its array. """
+        values = numpy.fromstring(code_string, dtype=numpy.int64, sep=" ")
+        # fromstring stops quietly at the first token it can't parse
+        if len(values) != len(code_string.split()):
+            raise ValueError("code string has a token that isn't an integer")
+        if len(values) % 2:
+            raise ValueError("code string has a code without a time")
+        (codes, times) = (values[0::2], values[1::2])
+        if len(values) and (codes.min() < 0 or codes.max() > 0xffffffff
+                            or times.min() < -0x80000000 or times.max() > 0x7fffffff):
+            raise ValueError("code string has a value out of range")
+        return cls(codes, times)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __str__(self):
+        values = numpy.empty(2 * len(self.codes), dtype=numpy.int64)
+        values[0::2] = self.codes
+        values[1::2] = self.times
+        return " ".join(map(str, values.tolist()))
+
+    def __repr__(self):
+        return "<Codes (%d codes)>" % len(self)
+
+    def __eq__(self, other):
+        return isinstance(other, Codes) and numpy.array_equal(self.codes, other.codes) \
+            and numpy.array_equal(self.times, other.times)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def take(self, index):
+        """ Codes at the given positions (an index array, mask or slice) """
+        return Codes(self.codes[index], self.times[index])
+
+def _as_codes(code_string):
+    if isinstance(code_string, Codes):
+        return code_string
+    return Codes.from_string(code_string)
+
+def _like(codes, code_string):
+    """ Return codes in the same form (Codes or string) as code_string """
+    if isinstance(code_string, Codes):
+        return codes
+    return str(codes)
+
+def _code_text(code_string):
+    """ The keystore / Solr form of a code string """
+    if isinstance(code_string, Codes):
+        return str(code_string)
+    return code_string.encode("utf-8")
+
+
+# Value of each ASCII hex digit, -1 for anything else
+_HEX_VALUES = numpy.empty(256, dtype=numpy.int32)
+_HEX_VALUES.fill(-1)
+for (i, c) in enumerate("0123456789abcdef"):
+    _HEX_VALUES[ord(c)] = _HEX_VALUES[ord(c.upper())] = i
+_HEX_PLACES = 16 ** numpy.arange(4, -1, -1, dtype=numpy.int32)
+
+def inflate_codes(s):
     """ Takes an uncompressed code string consisting of 0-padded fixed-width
-        sorted hex and converts it to the standard code string."""
+        sorted hex and converts it to Codes. The hex digits are decoded
+        with array operations: n groups of 5 digit timestamps, then n groups
+        of 5 digit hash codes. """
     n = int(len(s) / 10.0) # 5 hex bytes for hash, 5 hex bytes for time (40 bits)
+    digits = _HEX_VALUES[numpy.frombuffer(s, dtype=numpy.uint8, count=n*10)]
+    if (digits < 0).any():
+        raise ValueError("invalid hex in code string")
+    values = digits.reshape(-1, 5).dot(_HEX_PLACES)
+    return Codes(values[n:], values[:n])
 
-    def pairs(l, n=2):
-        """Non-overlapping [1,2,3,4] -> [(1,2), (3,4)]"""
-        # return zip(*[[v for i,v in enumerate(l) if i % n == j] for j in range(n)])
-        end = n
-        res = []
-        while end <= len(l):
-            start = end - n
-            res.append(tuple(l[start:end]))
-            end += n
-        return res
-
-    # Parse out n groups of 5 timestamps in hex; then n groups of 8 hash codes in hex.
-    end_timestamps = n*5
-    times = [int(''.join(t), 16) for t in chunker(s[:end_timestamps], 5)]
-    codes = [int(''.join(t), 16) for t in chunker(s[end_timestamps:], 5)]
-
-    assert(len(times) == len(codes)) # these should match up!
-    return ' '.join('%d %d' % (c, t) for c,t in zip(codes, times))
+def inflate_code_string(s):
+    """ Takes an uncompressed code string consisting of 0-padded fixed-width
+        sorted hex and converts it to the standard code string."""
+    return str(inflate_codes(s))
 
-def decode_code_string(compressed_code_string):
+def decode_codes(compressed_code_string):
+    """ Decode a compressed code string from the codegen into Codes.
+        Returns None if the string can't be decoded. """
     compressed_code_string = compressed_code_string.encode('utf8')
     if compressed_code_string == "":
-        return ""
+        return Codes()
     # do the zlib/base64 stuff
     try:
         # this will decode both URL safe b64 and non-url-safe
         actual_code = zlib.decompress(base64.urlsafe_b64decode(compressed_code_string))
-    except (zlib.error, TypeError):
+        # If it is a deflated code, expand it from hex
+        if ' ' not in actual_code:
+            return inflate_codes(actual_code)
+    except (zlib.error, TypeError, ValueError):
         logger.warn("Could not decode base64 zlib string %s" % (compressed_code_string))
         import traceback; logger.warn(traceback.format_exc())
         return None
-    # If it is a deflated code, expand it from hex
-    if ' ' not in actual_code:
-        actual_code = inflate_code_string(actual_code)
-    return actual_code
+    try:
+        return Codes.from_string(actual_code)
+    except ValueError, e:
+        logger.warn("Could not decode code string %s: %s" % (compressed_code_string, e))
+        return None
+
+def decode_code_string(compressed_code_string):
+    codes = decode_codes(compressed_code_string)
+    if codes is None:
+        return None
+    return str(codes)
 
 def metadata_for_track_id(track_id, local=False):
     if not track_id or not len(track_id):
@@ -109,100 +225,313 @@ def metadata_for_track_id(track_id, local=False):
     if "-" not in track_id:
         track_id = "%s-0" % track_id
         
+    # Callers may change the dict they get, so it is never the cached one
     if local:
-        return _fake_solr["metadata"][track_id]
-        
+        return dict(_local_index.metadata(track_id))
+
+    meta = _metadata_cache.get(track_id.split("-")[0])
+    if meta is not None:
+        return dict(meta)
+
     with solr.pooled_connection(_fp_solr) as host:
-        response = host.query("track_id:%s" % track_id)
+        response = host.query("track_id:%s" % track_id, fields=METADATA_FIELDS, score=False)
+    return _metadata_response(track_id, response)
+
+def metadata_for_track_ids(track_ids, local=False):
+    """ metadata_for_track_id for each of track_ids, as a dict by track id.
+        Those that aren't cached are looked up together. """
+    metadata = {}
+    missing = {}
+    for track_id in set(track_ids):
+        if not track_id:
+            continue
+        full_id = track_id
+        if "-" not in full_id:
+            full_id = "%s-0" % full_id
+        meta = None
+        if local:
+            meta = _local_index.metadata(full_id)
+        else:
+            meta = _metadata_cache.get(full_id.split("-")[0])
+        if meta is not None:
+            metadata[track_id] = dict(meta)
+        else:
+            missing[full_id] = track_id
+
+    full_ids = sorted(missing)
+    for start in xrange(0, len(full_ids), METADATA_BATCH):
+        chunk = full_ids[start:start + METADATA_BATCH]
+        with solr.pooled_connection(_fp_solr) as host:
+            response = host.query("track_id:(%s)" % " OR ".join(chunk), rows=len(chunk),
+                                  fields=METADATA_FIELDS, score=False)
+        for r in response.results:
+            full_id = r["track_id"].encode("utf8")
+            if full_id in missing:
+                meta = _track_metadata(r)
+                _metadata_cache.put(full_id.split("-")[0], meta)
+                metadata[missing[full_id]] = dict(meta)
+    for track_id in missing.itervalues():
+        metadata.setdefault(track_id, {})
+    return metadata
+
+def metadata_for_track_id_async(track_id, local=False):
+    """ metadata_for_track_id for the event loop; returns a Future """
+    if not track_id or not len(track_id):
+        return asynctyrant.resolved({})
+    if "-" not in track_id:
+        track_id = "%s-0" % track_id
 
+    if local:
+        return asynctyrant.resolved(dict(_local_index.metadata(track_id)))
+
+    meta = _metadata_cache.get(track_id.split("-")[0])
+    if meta is not None:
+        return asynctyrant.resolved(dict(meta))
+
+    response = get_async_solr().query("track_id:%s" % track_id, fields=METADATA_FIELDS, score=False)
+    return response.then(lambda response: _metadata_response(track_id, response))
+
+def _metadata_response(track_id, response):
     if len(response.results):
-        return response.results[0]
+        meta = _track_metadata(response.results[0])
+        _metadata_cache.put(track_id.split("-")[0], meta)
+        return dict(meta)
     else:
         return {}
 
+def _track_metadata(doc):
+    """ The metadata of the track a Solr doc is a segment of: its
+        METADATA_FIELDS, with the track id of the track's first segment """
+    meta = dict((k, v) for (k, v) in doc.items() if k in _METADATA_KEYS)
+    meta["track_id"] = "%s-0" % doc["track_id"].split("-")[0]
+    return meta
+
+def _cache_metadata(results):
+    """ Remember the metadata of query_fp results fetched with get_data """
+    for r in results:
+        _metadata_cache.put(r["track_id"].split("-")[0], _track_metadata(r))
+
 def cut_code_string_length(code_string):
     """ Remove all codes from a codestring that are > 60 seconds in length.
     Because we can only match 60 sec, everything else is unnecessary """
-    split = code_string.split()
-    if len(split) < 2:
+    codes = _as_codes(code_string)
+    if len(codes) == 0:
         return code_string
 
     # If we use the codegen on a file with start/stop times, the first timestamp
     # is ~= the start time given. There might be a (slightly) earlier timestamp
     # in another band, but this is good enough
-    first_timestamp = int(split[1])
+    first_timestamp = int(codes.times[0])
     sixty_seconds = int(60.0 * 1000.0 / 23.2 + first_timestamp)
-    parts = []
-    for (code, t) in zip(split[::2], split[1::2]):
-        tstamp = int(t)
-        if tstamp <= sixty_seconds:
-            parts.append(code)
-            parts.append(t)
-    return " ".join(parts)
+    return _like(codes.take(codes.times <= sixty_seconds), code_string)
 
 def best_match_for_query(code_string, elbow=10, local=False):
-    # DEC strings come in as unicode so we have to force them to ASCII
-    code_string = code_string.encode("utf8")
     tic = int(time.time()*1000)
 
-    # First see if this is a compressed code
-    if re.match('[A-Za-z\/\+\_\-]', code_string) is not None:
-        code_string = decode_code_string(code_string)
-        if code_string is None:
-            return Response(Response.CANNOT_DECODE, tic=tic)
+    prepared = _prepare_query(code_string, elbow, local, tic)
+    if isinstance(prepared, Response):
+        return prepared
+    (code_string, cache_slot) = prepared
+    response = _match_codes(code_string, elbow, local, tic)
+    _cache_response(cache_slot, response)
+    return response
+
+def best_match_for_query_async(code_string, elbow=10, local=False):
+    """ best_match_for_query for the event loop (see get_async_map). Returns
+        a Future of the Response. Its Solr query, keystore fetch and metadata
+        lookup don't block, so many queries can be in flight at once. """
+    tic = int(time.time()*1000)
+
+    prepared = _prepare_query(code_string, elbow, local, tic)
+    if isinstance(prepared, Response):
+        return asynctyrant.resolved(prepared)
+    (code_string, cache_slot) = prepared
+    def matched(response):
+        _cache_response(cache_slot, response)
+        return response
+    return _match_codes_async(code_string, elbow, local, tic).then(matched)
+
+def best_match_for_queries(code_strings, elbow=10, local=False):
+    """ best_match_for_query for each of code_strings, in order. The keystore
+        codes and the metadata are fetched once for the whole batch. """
+    tic = int(time.time()*1000)
+
+    responses = [None] * len(code_strings)
+    pending = [] # (index, cache slot, item for _settle)
+    for (i, code_string) in enumerate(code_strings):
+        prepared = _prepare_query(code_string, elbow, local, tic)
+        if isinstance(prepared, Response):
+            responses[i] = prepared
+            continue
+        (codes, cache_slot) = prepared
+        response = query_fp(codes, rows=30, local=local, get_data=True)
+        pending.append((i, cache_slot, [codes, response, _solr_verdict(response, len(codes), elbow), elbow]))
+
+    metadata = _settle([item for (i, cache_slot, item) in pending], local)
+    for (i, cache_slot, (codes, response, verdict, elbow)) in pending:
+        responses[i] = _verdict_response(verdict, response, metadata.get(verdict[1], {}), tic)
+        _cache_response(cache_slot, responses[i])
+    return responses
+
+def _settle(items, local):
+    """ Rescore the [codes, Solr response, verdict, elbow] items that have no
+        verdict yet, from one keystore fetch, and look up the metadata of
+        all their matches at once. Returns the metadata by track id. """
+    rescore = [item for item in items if item[2] is None]
+    trackids = sorted(set(t for item in rescore for t in _result_track_ids(item[1])))
+    tcodes = dict(zip(trackids, fp_codes_for_track_ids(trackids, local=local)))
+    for item in rescore:
+        item[2] = _rescored_verdict(item[1], item[0], [tcodes[t] for t in _result_track_ids(item[1])], item[3])
+    return metadata_for_track_ids([item[2][1] for item in items if item[2][1] is not None], local=local)
+
+def _prepare_query(code_string, elbow, local, tic):
+    """ Decode and cut the query codes. Returns a Response if that (or a
+        cache) answers the query already, else the codes and a cache slot
+        for _cache_response. """
+    if not isinstance(code_string, Codes):
+        # DEC strings come in as unicode so we have to force them to ASCII
+        code_string = code_string.encode("utf8")
+        # First see if this is a compressed code
+        if re.match('[A-Za-z\/\+\_\-]', code_string) is not None:
+            code_string = decode_codes(code_string)
+            if code_string is None:
+                return Response(Response.CANNOT_DECODE, tic=tic)
+        else:
+            try:
+                code_string = Codes.from_string(code_string)
+            except ValueError:
+                return Response(Response.CANNOT_DECODE, tic=tic)
     
-    code_len = len(code_string.split(" ")) / 2
+    code_len = len(code_string)
     if code_len < elbow:
         logger.warn("Query code length (%d) is less than elbow (%d)" % (code_len, elbow))
         return Response(Response.NOT_ENOUGH_CODE, tic=tic)
 
     code_string = cut_code_string_length(code_string)
-    code_len = len(code_string.split(" ")) / 2
+
+    known_hashes = _known_hashes
+    if known_hashes is not None and known_hashes.fraction(code_string.codes) < KNOWN_HASH_FRACTION:
+        return Response(Response.NO_RESULTS, tic=tic)
+
+    # The query cache holds every kind of response; without it, only misses are kept
+    query_cache = _query_cache
+    if query_cache is None:
+        query_cache = _negative_cache
+    key = _query_digest(code_string, elbow, local)
+    cached = query_cache.get(key)
+    if cached is not None:
+        return Response(cached.code, TRID=cached.TRID, score=cached.score, qtime=cached.qtime, tic=tic, metadata=dict(cached.metadata))
+    return (code_string, (query_cache, key, query_cache.generation))
+
+def _cache_response(cache_slot, response):
+    (query_cache, key, generation) = cache_slot
+    # The caller keeps response, and may change it or its metadata
+    response = copy.copy(response)
+    response.metadata = dict(response.metadata)
+    if response.code in _NO_MATCH:
+        # A track ingested elsewhere should be found soon
+        ttl = _negative_cache.ttl
+        if query_cache.ttl is not None:
+            ttl = min(ttl, query_cache.ttl)
+        query_cache.put(key, response, generation, ttl=ttl)
+    elif query_cache is not _negative_cache:
+        query_cache.put(key, response, generation)
+
+_NO_MATCH = (Response.NO_RESULTS, Response.SINGLE_BAD_MATCH, Response.MULTIPLE_BAD_HISTOGRAM_MATCH)
+
+def _match_codes(code_string, elbow, local, tic):
+    """ The matching part of best_match_for_query, for decoded and cut codes """
+    scheduler = _query_scheduler
+    if scheduler is not None and not local:
+        return scheduler.match(code_string, elbow, tic)
 
     # Query the FP flat directly.
     response = query_fp(code_string, rows=30, local=local, get_data=True)
+    verdict = _solr_verdict(response, len(code_string), elbow)
+    if verdict is None:
+        # Not a strong match, so we look up the codes in the keystore and compute actual matches...
+        trackids = _result_track_ids(response)
+        tcodes = fp_codes_for_track_ids(trackids, local=local)
+        verdict = _rescored_verdict(response, code_string, tcodes, elbow)
+
+    meta = {}
+    if verdict[1] is not None:
+        meta = metadata_for_track_id(verdict[1], local=local)
+    return _verdict_response(verdict, response, meta, tic)
+
+def _match_codes_async(code_string, elbow, local, tic):
+    def solr_done(response):
+        verdict = _solr_verdict(response, len(code_string), elbow)
+        if verdict is not None:
+            return _verdict_response_async(verdict, response, tic, local)
+        trackids = _result_track_ids(response)
+        # Look up the metadata of Solr's best match while the codes are
+        # fetched: it's usually still the best after rescoring
+        guess = trackids[0].split("-")[0]
+        guess_meta = metadata_for_track_id_async(guess, local=local)
+        def codes_done(tcodes):
+            verdict = _rescored_verdict(response, code_string, tcodes, elbow)
+            if verdict[1] == guess:
+                return guess_meta.then(lambda meta: _verdict_response(verdict, response, meta, tic))
+            return _verdict_response_async(verdict, response, tic, local)
+        return fp_codes_for_track_ids_async(trackids, local=local).then(codes_done)
+    return query_fp_async(code_string, rows=30, local=local, get_data=True).then(solr_done)
+
+def _result_track_ids(response):
+    return [r["track_id"].encode("utf8") for r in response.results]
+
+def _verdict_response(verdict, response, meta, tic):
+    (code, trid, score) = verdict
+    return Response(code, TRID=trid, score=score, qtime=response.header["QTime"], tic=tic, metadata=meta)
+
+def _verdict_response_async(verdict, response, tic, local):
+    if verdict[1] is None:
+        return _verdict_response(verdict, response, {}, tic)
+    meta = metadata_for_track_id_async(verdict[1], local=local)
+    return meta.then(lambda meta: _verdict_response(verdict, response, meta, tic))
+
+def _solr_verdict(response, code_len, elbow):
+    """ The (response code, track id, score) that the Solr results alone
+        decide, or None if they have to be rescored """
     logger.debug("solr qtime is %d" % (response.header["QTime"]))
     
     if len(response.results) == 0:
-        return Response(Response.NO_RESULTS, qtime=response.header["QTime"], tic=tic)
+        return (Response.NO_RESULTS, None, 0)
 
     # If we just had one result, make sure that it is close enough. We rarely if ever have a single match so this is not helpful (and probably doesn't work well.)
     top_match_score = int(response.results[0]["score"])
     if len(response.results) == 1:
         trackid = response.results[0]["track_id"]
         trackid = trackid.split("-")[0] # will work even if no `-` in trid
-        meta = metadata_for_track_id(trackid, local=local)
         if code_len - top_match_score < elbow:
-            return Response(Response.SINGLE_GOOD_MATCH, TRID=trackid, score=top_match_score, qtime=response.header["QTime"], tic=tic, metadata=meta)
+            return (Response.SINGLE_GOOD_MATCH, trackid, top_match_score)
         else:
-            return Response(Response.SINGLE_BAD_MATCH, qtime=response.header["QTime"], tic=tic)
+            return (Response.SINGLE_BAD_MATCH, None, 0)
 
     # If the scores are really low (less than 5% of the query length) then say no results
     if top_match_score < code_len * 0.05:
-        return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime = response.header["QTime"], tic=tic)
+        return (Response.MULTIPLE_BAD_HISTOGRAM_MATCH, None, 0)
+    return None
 
-    # Not a strong match, so we look up the codes in the keystore and compute actual matches...
+def _rescored_verdict(response, code_string, tcodes, elbow):
+    """ The (response code, track id, score) from rescoring the Solr results
+        with their codes from the keystore """
+    code_len = len(code_string)
 
     # Get the actual score for all responses
     original_scores = {}
     actual_scores = {}
     
-    trackids = [r["track_id"].encode("utf8") for r in response.results]
-    if local:
-        tcodes = [_fake_solr["store"][t] for t in trackids]
-    else:
-        tcodes = get_tyrant().multi_get(trackids)
-    
     # For each result compute the "actual score" (based on the histogram matching)
+    tscores = actual_matches_batch(code_string, tcodes, elbow = elbow)
     for (i, r) in enumerate(response.results):
         track_id = r["track_id"]
         original_scores[track_id] = int(r["score"])
-        track_code = tcodes[i]
-        if track_code is None:
+        if tscores[i] is None:
             # Solr gave us back a track id but that track
             # is not in our keystore
             continue
-        actual_scores[track_id] = actual_matches(code_string, track_code, elbow = elbow)
+        actual_scores[track_id] = tscores[i]
     
     #logger.debug("Actual score for %s is %d (code_len %d), original was %d" % (r["track_id"], actual_scores[r["track_id"]], code_len, top_match_score))
     # Sort the actual scores
@@ -225,18 +554,17 @@ def best_match_for_query(code_string, elbow=10, local=False):
         (top_track_id, top_score) = sorted_actual_scores[0]
         if top_score < code_len * 0.1:
             logger.info("only result less than 10%% of the query string (%d < %d *0.1 (%d)) SINGLE_BAD_MATCH", top_score, code_len, code_len*0.1)
-            return Response(Response.SINGLE_BAD_MATCH, qtime = response.header["QTime"], tic=tic)
+            return (Response.SINGLE_BAD_MATCH, None, 0)
         else:
             if top_score > (original_scores[top_track_id] / 2): 
                 logger.info("top_score > original_scores[%s]/2 (%d > %d) GOOD_MATCH_DECREASED",
                     top_track_id, top_score, original_scores[top_track_id]/2)
                 trid = top_track_id.split("-")[0]
-                meta = metadata_for_track_id(trid, local=local)
-                return Response(Response.MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, TRID=trid, score=top_score, qtime=response.header["QTime"], tic=tic, metadata=meta)
+                return (Response.MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, trid, top_score)
             else:
                 logger.info("top_score NOT > original_scores[%s]/2 (%d <= %d) BAD_HISTOGRAM_MATCH",
                     top_track_id, top_score, original_scores[top_track_id]/2)
-                return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic)
+                return (Response.MULTIPLE_BAD_HISTOGRAM_MATCH, None, 0)
         
     # Get the top one
     (actual_score_top_track_id, actual_score_top_score) = sorted_actual_scores[0]
@@ -244,90 +572,283 @@ def best_match_for_query(code_string, elbow=10, local=False):
     (actual_score_2nd_track_id, actual_score_2nd_score) = sorted_actual_scores[1]
 
     trackid = actual_score_top_track_id.split("-")[0]
-    meta = metadata_for_track_id(trackid, local=local)
     
     if actual_score_top_score < code_len * 0.05:
-        return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime = response.header["QTime"], tic=tic)
+        return (Response.MULTIPLE_BAD_HISTOGRAM_MATCH, None, 0)
     else:
         # If the actual score went down it still could be close enough, so check for that
         if actual_score_top_score > (original_scores[actual_score_top_track_id] / 4): 
             if (actual_score_top_score - actual_score_2nd_score) >= (actual_score_top_score / 3):  # for examples [10,4], 10-4 = 6, which >= 5, so OK
-                return Response(Response.MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, TRID=trackid, score=actual_score_top_score, qtime=response.header["QTime"], tic=tic, metadata=meta)
+                return (Response.MULTIPLE_GOOD_MATCH_HISTOGRAM_DECREASED, trackid, actual_score_top_score)
             else:
-                return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime = response.header["QTime"], tic=tic)
+                return (Response.MULTIPLE_BAD_HISTOGRAM_MATCH, None, 0)
         else:
             # If the actual score was not close enough, then no match.
-            return Response(Response.MULTIPLE_BAD_HISTOGRAM_MATCH, qtime=response.header["QTime"], tic=tic)
+            return (Response.MULTIPLE_BAD_HISTOGRAM_MATCH, None, 0)
+
+def _query_digest(codes, elbow, local):
+    """ A digest of the codes that doesn't depend on their order or on when
+        the query started, since neither changes its matches """
+    times = codes.times.astype(numpy.int64) - codes.times.min()
+    order = numpy.lexsort((codes.codes, times))
+    digest = hashlib.sha1("%d %d " % (elbow, local))
+    digest.update(codes.codes[order].tostring())
+    digest.update(times[order].tostring())
+    return digest.digest()
+
+def set_query_cache(maxsize=10000, ttl=60):
+    """ Cache up to maxsize best_match_for_query responses, for clients that
+        repeat queries. Ingest, delete and commit in this process empty it;
+        ttl bounds how long a response can miss a write made elsewhere
+        (another worker, fastingest, the replication scripts), and no-match
+        responses expire as soon as those of the negative cache. A maxsize
+        of 0 turns it off. """
+    global _query_cache
+    if maxsize:
+        _query_cache = cache.LRUCache(maxsize, ttl=ttl)
+    else:
+        _query_cache = None
 
-def actual_matches(code_string_query, code_string_match, slop = 2, elbow = 10):
-    code_query = code_string_query.split(" ")
-    code_match = code_string_match.split(" ")
-    if (len(code_match) < (elbow*2)):
+def query_cache_stats():
+    """ Size and hit rate of the query cache, or None when it is off """
+    if _query_cache is None:
+        return None
+    return _query_cache.stats()
+
+class QueryScheduler(object):
+    """ Settles concurrent best_match_for_query calls together. Each call
+        queries Solr itself, then those that need keystore codes or metadata
+        are collected for up to window seconds (or max_queries of them) and
+        get both from one round trip each, as in best_match_for_queries.
+        Collecting stops early once every query in flight has joined, so a
+        lone query doesn't wait at all. """
+    def __init__(self, window=0.002, max_queries=32):
+        self.window = window
+        self.max_queries = max_queries
+        self._cond = threading.Condition()
+        self._pending = []
+        self._collecting = False
+        self._in_flight = 0
+        self.batches = 0
+        self.settled = 0
+
+    def match(self, code_string, elbow, tic):
+        with self._cond:
+            self._in_flight += 1
+        try:
+            response = query_fp(code_string, rows=30, get_data=True)
+            item = [code_string, response, _solr_verdict(response, len(code_string), elbow), elbow]
+            meta = {}
+            if item[2] is None or item[2][1] is not None:
+                meta = self._settle(item)
+            return _verdict_response(item[2], response, meta, tic)
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"batches": self.batches, "settled": self.settled,
+                    "mean_batch": self.batches and float(self.settled) / self.batches}
+
+    def _settle(self, item):
+        """ Settle item along with whatever joins it; returns its metadata """
+        waiter = {"item": item}
+        with self._cond:
+            self._pending.append(waiter)
+            if self._collecting:
+                # Another call is collecting this batch and will settle it
+                while "meta" not in waiter:
+                    self._cond.wait()
+                if "error" in waiter:
+                    raise waiter["error"]
+                return waiter["meta"]
+            self._collecting = True
+            deadline = time.time() + self.window
+            while len(self._pending) < min(self.max_queries, self._in_flight):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            (batch, self._pending) = (self._pending, [])
+            self._collecting = False
+            self.batches += 1
+            self.settled += len(batch)
+
+        # The next batch collects while this one is fetched
+        try:
+            metadata = _settle([w["item"] for w in batch], False)
+        except Exception, e:
+            for w in batch:
+                (w["error"], w["meta"]) = (e, {})
+        else:
+            for w in batch:
+                trid = w["item"][2][1]
+                w["meta"] = trid is not None and metadata.get(trid, {}) or {}
+        with self._cond:
+            self._cond.notify_all()
+        if "error" in waiter:
+            raise waiter["error"]
+        return waiter["meta"]
+
+def set_query_batching(window=0.002, max_queries=32):
+    """ Settle concurrent best_match_for_query calls in batches (see
+        QueryScheduler), for servers that run many at once. A window of
+        None turns it off. """
+    global _query_scheduler
+    if window is not None:
+        _query_scheduler = QueryScheduler(window, max_queries)
+    else:
+        _query_scheduler = None
+
+def _invalidate_queries():
+    if _query_cache is not None:
+        _query_cache.clear()
+    _negative_cache.clear()
+
+def load_hash_filter(filename=None, local=False):
+    """ Start skipping queries for audio that can't be in the index. The
+        set of indexed hashes is read from filename (see save_hash_filter)
+        or else built from the keystore, which reads every code. Ingests
+        made through this process are added to it; ingests by other
+        processes aren't, so it should be rebuilt after them. """
+    global _known_hashes
+    if filename is not None:
+        _known_hashes = hashset.HashSet.load(filename)
+        return
+    hashes = hashset.HashSet()
+    if local:
+        hashes.add(_local_index.hashes())
+    else:
+        tyrant = get_tyrant()
+        for trackids in chunker(tyrant.keys(), 1000):
+            for code in tyrant.multi_get(trackids):
+                if code is not None:
+                    hashes.add(Codes.from_string(code).codes)
+    _known_hashes = hashes
+
+def save_hash_filter(filename):
+    _known_hashes.save(filename)
+
+def unload_hash_filter():
+    global _known_hashes
+    _known_hashes = None
+
+def _invert_query(codes, times, slop=2):
+    """ Invert the query codes. Times are normalised to start at 0 and divided
+        by slop. Returns the sorted unique query codes and, for each one, the
+        latest time it occurs at in the query. """
+    # int64, since the span of int32 times needn't fit an int32
+    times = times.astype(numpy.int64)
+    times = (times - times.min()) // slop
+    order = numpy.lexsort((times, codes))
+    codes = codes[order]
+    times = times[order]
+    # keep the last (i.e. latest) entry of each run of equal codes
+    last = numpy.ones(len(codes), dtype=bool)
+    last[:-1] = codes[1:] != codes[:-1]
+    return (codes[last], times[last])
+
+def _histogram_score(inverted_query, match_codes, match_times, slop=2):
+    """ Build the histogram of time offsets between the document codes and
+        the query codes they match and return the sum of its two biggest bins. """
+    (query_codes, query_times) = inverted_query
+    if not len(query_codes) or not len(match_codes):
         return 0
+    idx = numpy.searchsorted(query_codes, match_codes)
+    idx[idx == len(query_codes)] = 0
+    hit = query_codes[idx] == match_codes
+    # match_time > qtime for all corresponding hashcodes since the query times
+    # are normalised, so the smallest distance is to the latest query time
+    diffs = match_times[hit].astype(numpy.int64) // slop - query_times[idx[hit]]
+    diffs = diffs[diffs < 32767]
+    if not len(diffs):
+        return 0
+    # Only count the offsets that occur: a query can span any int32 times,
+    # too many for a bin each
+    counts = numpy.unique(diffs, return_counts=True)[1]
+    if len(counts) > 1:
+        return int(numpy.partition(counts, len(counts) - 2)[-2:].sum())
+    return int(counts[0])
 
-    time_diffs = {}
-
-    # Normalise the query timecodes to start with offset 0
-    code_query_int = [int(x) for x in code_query]
-    min_time = min(code_query_int[1::2])
-    code_query[1::2] = [str(x - min_time) for x in code_query_int[1::2]]
-    
-    #
-    # Invert the query codes
-    query_codes = {}
-    for (qcode, qtime) in zip(code_query[::2], code_query[1::2]):
-        qtime = int(qtime) / slop
-        if qcode in query_codes:
-            query_codes[qcode].append(qtime)
+def actual_matches(code_string_query, code_string_match, slop = 2, elbow = 10):
+    """ Score a document against a query by histogramming the time offsets of
+        their shared codes. The score is the size of the top 2 bins. """
+    match = _as_codes(code_string_match)
+    if len(match) < elbow:
+        return 0
+    query = _as_codes(code_string_query)
+    if not len(query):
+        return 0
+    inverted_query = _invert_query(query.codes, query.times, slop)
+    return _histogram_score(inverted_query, match.codes, match.times, slop)
+
+def actual_matches_batch(code_string_query, code_strings_match, slop = 2, elbow = 10):
+    """ Score many documents against one query, see actual_matches. The query
+        is parsed and inverted once. Returns a list of scores in the same
+        order as code_strings_match, with None for documents that are None
+        (e.g. track ids missing from the keystore). """
+    query = _as_codes(code_string_query)
+    inverted_query = None
+    if len(query):
+        inverted_query = _invert_query(query.codes, query.times, slop)
+    scores = []
+    for code_string_match in code_strings_match:
+        if code_string_match is None:
+            scores.append(None)
+            continue
+        match = _as_codes(code_string_match)
+        if inverted_query is None or len(match) < elbow:
+            scores.append(0)
         else:
-            query_codes[qcode] = [qtime]
-
-    #
-    # Walk the document codes, handling those that occur in the query
-    match_counter = 1
-    for match_code in code_match[::2]:
-        if match_code in query_codes:
-            match_code_time = int(code_match[match_counter])/slop
-            min_dist = 32767
-            for qtime in query_codes[match_code]:
-                # match_code_time > qtime for all corresponding
-                # hashcodes since normalising query timecodes, so no
-                # need for abs() anymore
-                dist = match_code_time - qtime
-                if dist < min_dist:
-                    min_dist = dist
-            if min_dist < 32767:
-                if time_diffs.has_key(min_dist):
-                    time_diffs[min_dist] += 1
-                else:
-                    time_diffs[min_dist] = 1
-        match_counter += 2
-
-    # sort the histogram, pick the top 2 and return that as your actual score
-    actual_match_list = sorted(time_diffs.iteritems(), key=lambda (k,v): (v,k), reverse=True)
-
-    if(len(actual_match_list)>1):
-        return actual_match_list[0][1] + actual_match_list[1][1]
-    if(len(actual_match_list)>0):
-        return actual_match_list[0][1]
-    return 0        
+            scores.append(_histogram_score(inverted_query, match.codes, match.times, slop))
+    return scores
 
 def get_tyrant():
+    """ The keystore client. It pools its connections, so threads can share it. """
     global _tyrant
-    if _tyrant is None:
-        _tyrant = pytyrant.PyTyrant.open(*_tyrant_address)
+    with _tyrant_lock:
+        if _tyrant is None:
+            _tyrant = pytyrant.PooledPyTyrant.open(*_tyrant_address, pool_size=_tyrant_pool_size)
     return _tyrant
 
+"""
+    The *_async functions run on one asyncore event loop, whose socket map is
+    get_async_map(); they return asynctyrant Futures, resolved as the loop
+    runs. Drive it with asyncore.loop(map=fp.get_async_map()) or, to wait
+    for some futures, asynctyrant.wait(futures, map=fp.get_async_map()).
+    The loop and its clients are not thread safe: use them from one thread.
+"""
+_async_map = {}
+_async_solr = None
+_async_tyrant = None
+
+def get_async_map():
+    return _async_map
+
+def get_async_solr():
+    global _async_solr
+    if _async_solr is None:
+        _async_solr = asyncsolr.AsyncSolr(_fp_solr.url, map=_async_map)
+    return _async_solr
+
+def get_async_tyrant():
+    global _async_tyrant
+    if _async_tyrant is None:
+        _async_tyrant = asynctyrant.AsyncTyrant(*_tyrant_address, map=_async_map)
+    return _async_tyrant
+
 """
     fp can query the live production flat or the alt flat, or it can query and ingest in memory.
     the following few functions are to support local query and ingest that ape the response of the live server
     This is useful for small collections and testing, deduplicating, etc, without having to boot a server.
     The results should be equivalent but i need to run tests. 
     
-    NB: delete is not supported locally yet
+    The in-memory index itself is a localindex.LocalIndex.
     
 """
-_fake_solr = {"index": {}, "store": {}, "metadata": {}}
+_local_index = localindex.LocalIndex()
 
 class FakeSolrResponse(object):
     def __init__(self, results):
@@ -345,95 +866,91 @@ class FakeSolrResponse(object):
                 self.results.append(data)
             else:
                 self.results.append({"score":r[1], "track_id":r[0]})
+
+def _index_from_fake_solr(fake_solr):
+    """ Build a LocalIndex from a database saved as the old dict of
+        index, store and metadata """
+    index = localindex.LocalIndex()
+    for (trackid, code) in fake_solr["store"].iteritems():
+        code = _as_codes(code)
+        index.add(trackid, code.codes, code.times, fake_solr["metadata"].get(trackid, {}))
+    return index
     
+def _load_pickle(filename):
+    disk = open(filename,"rb")
+    fake_solr = pickle.load(disk)
+    disk.close()
+    return _index_from_fake_solr(fake_solr)
+
 def local_load(filename):
-    global _fake_solr
+    """ Load a local database saved with local_save. Databases pickled by
+        older versions of fp are read as well (slowly). """
+    global _local_index
+    _invalidate_queries()
     print "Loading from " + filename
     disk = open(filename,"rb")
-    _fake_solr = pickle.load(disk)
+    magic = disk.read(len(localindex.MAGIC))
     disk.close()
+    if magic == localindex.MAGIC:
+        _local_index = localindex.LocalIndex.open(filename)
+    else:
+        _local_index = _load_pickle(filename)
     print "Done"
     
-def local_save(filename):
+def local_save(filename, compact=False):
+    """ Save the local database. Saving again to the file it was loaded from
+        only appends the ingests and deletes since then to a journal, which
+        is compacted into the file when it gets big or when compact is set. """
     print "Saving to " + filename
-    disk = open(filename,"wb")
-    pickle.dump(_fake_solr,disk)
-    disk.close()
+    _local_index.save(filename, compact=compact)
+    print "Done"
+
+def local_convert(pickle_filename, filename):
+    """ Convert a local database pickled by older versions of fp to the
+        local index file format """
+    print "Converting %s to %s" % (pickle_filename, filename)
+    _load_pickle(pickle_filename).save(filename)
     print "Done"
     
 def local_ingest(docs, codes):
     store = dict(codes)
-    _fake_solr["store"].update(store)
     for fprint in docs:
         trackid = fprint["track_id"]
-        keys = set(fprint["fp"].split(" ")[0::2]) # just one code indexed
-        for k in keys:
-            tracks = _fake_solr["index"].setdefault(k,[])
-            if trackid not in tracks:
-                tracks.append(trackid)
-        _fake_solr["metadata"][trackid] = {"length": fprint["length"], "codever": fprint["codever"]}
+        code = _as_codes(store.get(trackid, fprint["fp"]))
+        metadata = {"length": fprint["length"], "codever": fprint["codever"]}
         if "artist" in fprint:
-            _fake_solr["metadata"][trackid]["artist"] = fprint["artist"]
+            metadata["artist"] = fprint["artist"]
         if "release" in fprint:
-            _fake_solr["metadata"][trackid]["release"] = fprint["release"]
+            metadata["release"] = fprint["release"]
         if "track" in fprint:
-            _fake_solr["metadata"][trackid]["track"] = fprint["track"]
+            metadata["track"] = fprint["track"]
+        _local_index.add(trackid, code.codes, code.times, metadata)
 
 def local_delete(tracks):
-    for track in tracks:
-        codes = set(_fake_solr["store"][track].split(" ")[0::2])
-        del _fake_solr["store"][track]
-        for code in codes:
-            # Make copy so destructive editing doesn't break for loop
-            codetracks = list(_fake_solr["index"][code])
-            for trid in codetracks:
-                if trid.startswith(track):
-                    _fake_solr["index"][code].remove(trid)
-                    try:
-                        del _fake_solr["metadata"][trid]
-                    except KeyError:
-                        pass
-            if len(_fake_solr["index"][code]) == 0:
-                del _fake_solr["index"][code]
-        
+    _local_index.delete(tracks)
 
 def local_dump():
     print "Stored tracks:"
-    print _fake_solr["store"].keys()
+    print list(_local_index.track_ids())
     print "Metadata:"
-    for t in _fake_solr["metadata"].keys():
-        print t, _fake_solr["metadata"][t]
+    for t in _local_index.track_ids():
+        print t, _local_index.metadata(t)
     print "Keys:"
-    for k in _fake_solr["index"].keys():
-        print "%s -> %s" % (k, ", ".join(_fake_solr["index"][k]))
+    for (k, tracks) in _local_index.postings():
+        print "%s -> %s" % (k, ", ".join(tracks))
 
 def local_query_fp(code_string,rows=10,get_data=False):
-    keys = code_string.split(" ")[0::2]
-    track_hist = []
-    unique_keys = []
-    for k in keys:
-        if k not in unique_keys:
-            track_hist += _fake_solr["index"].get(k, [])
-            unique_keys += [k]
-    top_matches = defaultdict(int)
-    for track in track_hist:
-        top_matches[track] += 1
-    if not get_data:
-        # Make a list of lists that have track_id, score
-        return FakeSolrResponse(sorted(top_matches.iteritems(), key=lambda (k,v): (v,k), reverse=True)[0:rows])
-    else:
-        # Make a list of lists that have track_id, score, then fp
-        lol = sorted(top_matches.iteritems(), key=lambda (k,v): (v,k), reverse=True)[0:rows]
-        lol = map(list, lol)
-        
+    # Make a list of lists that have track_id, score
+    lol = map(list, _local_index.query(_as_codes(code_string).codes, rows))
+    if get_data:
+        # add the fp and metadata
         for x in lol:
-            trackid = x[0].split("-")[0]
-            x.append(_fake_solr["store"][x[0]])
-            x.append(_fake_solr["metadata"][x[0]])
-        return FakeSolrResponse(lol)
+            x.append(local_fp_code_for_track_id(x[0]))
+            x.append(_local_index.metadata(x[0]))
+    return FakeSolrResponse(lol)
 
 def local_fp_code_for_track_id(track_id):
-    return _fake_solr["store"][track_id]
+    return Codes(*_local_index.codes(track_id))
     
 """
     and these are the server-hosted versions of query, ingest and delete 
@@ -445,9 +962,12 @@ def delete(track_ids, do_commit=True, local=False):
         track_ids = [track_ids]
 
     # delete a code from FP flat
+    _invalidate_queries()
     if local:
         return local_delete(track_ids)
 
+    _metadata_cache.invalidate([t.split("-")[0] for t in track_ids])
+
     with solr.pooled_connection(_fp_solr) as host:
         for t in track_ids:
             host.delete_query("track_id:%s*" % t)
@@ -461,8 +981,8 @@ def delete(track_ids, do_commit=True, local=False):
         commit()
 
 def local_erase_database():
-    global _fake_solr
-    _fake_solr = {"index": {}, "store": {}, "metadata": {}}
+    global _local_index
+    _local_index = localindex.LocalIndex()
 
 def erase_database(really_delete=False, local=False):
     """ This method will delete your ENTIRE database. Only use it if you
@@ -471,9 +991,11 @@ def erase_database(really_delete=False, local=False):
     if not really_delete:
         raise Exception("Won't delete unless you pass in really_delete=True")
 
+    _invalidate_queries()
     if local:
         return local_erase_database()
 
+    _metadata_cache.clear()
     with solr.pooled_connection(_fp_solr) as host:
         host.delete_query("*:*")
         host.commit()
@@ -494,39 +1016,28 @@ def split_codes(fp):
     halfsegment = segmentlength / 2.0
     
     trid = fp["track_id"]
-    codestring = fp["fp"]
+    codes = _as_codes(fp["fp"])
 
-    codes = codestring.split()
-    pairs = chunker(codes, 2)
-    pairs = [(int(x[1]), " ".join(x)) for x in pairs]
+    # Sort by time (then code)
+    codes = codes.take(numpy.lexsort((codes.codes, codes.times)))
 
-    pairs.sort()
-    size = len(pairs)
-
-    if len(pairs):
-        lasttime = pairs[-1][0]
+    if len(codes):
+        lasttime = int(codes.times[-1])
         numsegs = int(lasttime / halfsegment) + 1
     else:
         numsegs = 0
 
+    # Start and end index of each segment
+    starts = numpy.arange(numsegs) * halfsegment
+    sindexes = numpy.searchsorted(codes.times, starts, side="left")
+    eindexes = numpy.searchsorted(codes.times, starts + segmentlength, side="left")
+
     ret = []
-    sindex = 0
     for i in range(numsegs):
-        s = i * halfsegment
-        e = i * halfsegment + segmentlength
-        #print i, s, e
-        
-        while sindex < size and pairs[sindex][0] < s:
-            #print "s", sindex, l[sindex]
-            sindex+=1
-        eindex = sindex
-        while eindex < size and pairs[eindex][0] < e:
-            #print "e",eindex,l[eindex]
-            eindex+=1
         key = "%s-%d" % (trid, i)
         
         segment = {"track_id": key,
-                   "fp": " ".join((p[1]) for p in pairs[sindex:eindex]),
+                   "fp": _like(codes.take(slice(sindexes[i], eindexes[i])), fp["fp"]),
                    "length": fp["length"],
                    "codever": fp["codever"]}
         if "artist" in fp: segment["artist"] = fp["artist"]
@@ -541,7 +1052,7 @@ def ingest(fingerprint_list, do_commit=True, local=False, split=True):
     """ Ingest some fingerprints into the fingerprint database.
         The fingerprints should be of the form
           {"track_id": id,
-          "fp": fp string,
+          "fp": fp string or Codes,
           "artist": artist,
           "release": release,
           "track": track,
@@ -557,6 +1068,27 @@ def ingest(fingerprint_list, do_commit=True, local=False, split=True):
         length is the length of the track being ingested in seconds.
         if track_id is empty, one will be generated.
     """
+    (docs, codes) = prepare_ingest(fingerprint_list, split)
+
+    _invalidate_queries()
+    if _known_hashes is not None:
+        for (trackid, code) in codes:
+            _known_hashes.add(_as_codes(code).codes)
+    if local:
+        return local_ingest(docs, codes)
+
+    _metadata_cache.invalidate([d["track_id"].split("-")[0] for d in docs])
+
+    write_ingest_docs(docs)
+    write_ingest_codes(codes)
+
+    if do_commit:
+        commit()
+
+def prepare_ingest(fingerprint_list, split=True):
+    """ The Solr docs and the (track id, codes) keystore items that ingest
+        writes for fingerprint_list. This is all of ingest's own work, so
+        bulk loaders can do it in other processes. """
     if not isinstance(fingerprint_list, list):
         fingerprint_list = [fingerprint_list]
         
@@ -564,33 +1096,63 @@ def ingest(fingerprint_list, do_commit=True, local=False, split=True):
     codes = []
     if split:
         for fprint in fingerprint_list:
-            if not ("track_id" in fprint and "fp" in fprint and "length" in fprint and "codever" in fprint):
-                raise Exception("Missing required fingerprint parameters (track_id, fp, length, codever")
+            check_fingerprint(fprint)
             if "import_date" not in fprint:
                 fprint["import_date"] = IMPORTDATE
             if "source" not in fprint:
                 fprint["source"] = "local"
             split_prints = split_codes(fprint)
             docs.extend(split_prints)
-            codes.extend(((c["track_id"].encode("utf-8"), c["fp"].encode("utf-8")) for c in split_prints))
+            codes.extend(((c["track_id"].encode("utf-8"), c["fp"]) for c in split_prints))
     else:
         docs.extend(fingerprint_list)
-        codes.extend(((c["track_id"].encode("utf-8"), c["fp"].encode("utf-8")) for c in fingerprint_list))
-
-    if local:
-        return local_ingest(docs, codes)
+        codes.extend(((c["track_id"].encode("utf-8"), c["fp"]) for c in fingerprint_list))
+    return (docs, codes)
 
+def write_ingest_docs(docs):
+    """ Add prepare_ingest's docs to Solr, without committing """
+    # Codes are only turned into strings here, on their way to Solr and the keystore
     with solr.pooled_connection(_fp_solr) as host:
-        host.add_many(docs)
-
-    get_tyrant().multi_set(codes)
-
-    if do_commit:
-        commit()
+        host.add_many([_solr_doc(d) for d in docs])
+
+def write_ingest_codes(codes):
+    """ Write prepare_ingest's keystore items """
+    get_tyrant().multi_set([(trackid, _code_text(code)) for (trackid, code) in codes])
+
+_DATE_RE = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$")
+
+def check_fingerprint(fprint):
+    """ Raise ValueError if fprint is missing one of the parameters ingest
+        requires or has a value Solr won't take (see ingest). The code
+        string itself isn't parsed here. """
+    if not ("track_id" in fprint and "fp" in fprint and "length" in fprint and "codever" in fprint):
+        raise ValueError("Missing required fingerprint parameters (track_id, fp, length, codever")
+    for field in ("track_id", "codever", "artist", "release", "track", "source", "import_date"):
+        if field in fprint and not isinstance(fprint[field], basestring):
+            raise ValueError("%s must be a string" % field)
+    if not isinstance(fprint["fp"], (Codes, basestring)):
+        raise ValueError("fp must be a code string")
+    try:
+        # Solr's int field, which doesn't take "3.5" or "3.0" either
+        length = int(unicode(fprint["length"]))
+    except ValueError:
+        raise ValueError("length must be an integer")
+    if not -0x80000000 <= length <= 0x7fffffff:
+        raise ValueError("length is out of range")
+    if "import_date" in fprint and not _DATE_RE.match(fprint["import_date"]):
+        raise ValueError("import_date must be a date like %s" % IMPORTDATE)
+
+def _solr_doc(doc):
+    if isinstance(doc["fp"], Codes):
+        doc = dict(doc)
+        doc["fp"] = str(doc["fp"])
+    return doc
 
 def commit(local=False):
     with solr.pooled_connection(_fp_solr) as host:
         host.commit()
+    # Commit makes documents added without do_commit visible
+    _invalidate_queries()
 
 def query_fp(code_string, rows=15, local=False, get_data=False):
     if local:
@@ -599,21 +1161,64 @@ def query_fp(code_string, rows=15, local=False, get_data=False):
     try:
         # query the fp flat
         if get_data:
-            fields = "track_id,artist,release,track,length"
+            fields = METADATA_FIELDS
         else:
             fields = "track_id"
         with solr.pooled_connection(_fp_solr) as host:
-            resp = host.query(code_string, qt="/hashq", rows=rows, fields=fields)
+            resp = host.query(_code_text(code_string), qt="/hashq", rows=rows, fields=fields)
+        if get_data:
+            _cache_metadata(resp.results)
         return resp
     except solr.SolrException:
         return None
 
+def query_fp_async(code_string, rows=15, local=False, get_data=False):
+    """ query_fp for the event loop; returns a Future of the Solr response.
+        Solr errors fail the Future rather than giving None. """
+    if local:
+        return asynctyrant.resolved(local_query_fp(code_string, rows, get_data=get_data))
+
+    if get_data:
+        fields = METADATA_FIELDS
+    else:
+        fields = "track_id"
+    resp = get_async_solr().query(_code_text(code_string), qt="/hashq", rows=rows, fields=fields)
+    if get_data:
+        def got(resp):
+            _cache_metadata(resp.results)
+            return resp
+        resp = resp.then(got)
+    return resp
+
 def fp_code_for_track_id(track_id, local=False):
     if local:
         return local_fp_code_for_track_id(track_id)
     
     return get_tyrant().get(track_id.encode("utf-8"))
 
+def fp_codes_for_track_ids(track_ids, local=False):
+    """ The codes of each of track_ids, None for missing ones """
+    if local:
+        return [local_fp_code_for_track_id(t) for t in track_ids]
+
+    return get_tyrant().multi_get([t.encode("utf-8") for t in track_ids])
+
+def fp_code_for_track_id_async(track_id, local=False):
+    """ fp_code_for_track_id for the event loop; returns a Future """
+    if local:
+        return asynctyrant.resolved(local_fp_code_for_track_id(track_id))
+
+    # A get fails with KeyError for a missing track, where the blocking
+    # version gives None; a multi_get gives None too
+    return get_async_tyrant().multi_get([track_id.encode("utf-8")]).then(lambda codes: codes[0])
+
+def fp_codes_for_track_ids_async(track_ids, local=False):
+    """ A Future of the codes of each of track_ids, None for missing ones """
+    if local:
+        return asynctyrant.resolved([local_fp_code_for_track_id(t) for t in track_ids])
+
+    return get_async_tyrant().multi_get([t.encode("utf-8") for t in track_ids])
+
 def new_track_id():
     rand5 = ''.join(random.choice(string.letters) for x in xrange(5)).upper()
     global _hexpoch
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+hashset.py
+
+A bitset over the 2^20 possible hash codes (128KB) recording which of them
+are in the index. Hashes are only ever added: deleting tracks leaves their
+bits set, which can only make queries go on to Solr needlessly.
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import os
+import numpy
+
+from localindex import HASH_SPACE
+
+MAGIC = "EPHASHES"
+
+
+class HashSet(object):
+    def __init__(self):
+        self._bits = numpy.zeros(HASH_SPACE // 8, dtype=numpy.uint8)
+
+    @classmethod
+    def load(cls, filename):
+        """ Load a set saved with save() """
+        hashset = cls()
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a hash set file" % filename)
+            bits = numpy.fromfile(f, dtype=numpy.uint8)
+        if len(bits) != len(hashset._bits):
+            raise ValueError("%s was written for a different hash size" % filename)
+        hashset._bits = bits
+        return hashset
+
+    def save(self, filename):
+        tmpname = filename + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(MAGIC)
+            self._bits.tofile(f)
+        os.rename(tmpname, filename)
+
+    def __len__(self):
+        return int(numpy.unpackbits(self._bits).sum())
+
+    def add(self, codes):
+        """ Add an array of hash codes """
+        codes = numpy.unique(numpy.asarray(codes, dtype=numpy.uint32))
+        codes = codes[codes < HASH_SPACE]
+        # Codes in the same byte would overwrite each other with a plain
+        # indexed |=, so OR them together per byte first
+        (positions, first) = numpy.unique(codes >> 3, return_index=True)
+        values = numpy.left_shift(1, codes & 7).astype(numpy.uint8)
+        self._bits[positions] |= numpy.bitwise_or.reduceat(values, first)
+
+    def contains(self, codes):
+        """ A boolean array, true for each code that is in the set """
+        codes = numpy.asarray(codes, dtype=numpy.uint32)
+        known = codes < HASH_SPACE
+        codes = codes[known]
+        known[known] = (self._bits[codes >> 3] >> (codes & 7)) & 1 == 1
+        return known
+
+    def fraction(self, codes):
+        """ The fraction of codes that are in the set """
+        if not len(codes):
+            return 0.0
+        return float(self.contains(codes).sum()) / len(codes)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ingestqueue.py
+
+Group commit for ingest. Fingerprints submitted to an IngestQueue are
+buffered and written by a background thread in batches, each followed by a
+single Solr commit, so steady ingest traffic doesn't open a new searcher
+(and throw away its caches) for every track. A batch is flushed when it
+holds max_docs fingerprints or its oldest one has waited max_delay seconds.
+Fingerprints are checked when they are submitted, and if a batch still fails
+it is split in halves that are retried, so a bad fingerprint only fails its
+own ticket.
+
+Every submission gets a ticket, numbered in order, whose status can be
+asked for or waited on:
+
+    >>> q = ingestqueue.IngestQueue(max_docs=500, max_delay=2.0)
+    >>> ticket = q.submit(fingerprint)
+    >>> q.wait(ticket)
+    {'ticket': 1, 'status': 'committed'}
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import fp
+
+logger = logging.getLogger(__name__)
+
+# Ticket states
+QUEUED, FLUSHING, COMMITTED, FAILED, UNKNOWN = "queued", "flushing", "committed", "failed", "unknown"
+# Failures remembered; older tickets than these report UNKNOWN
+MAX_FAILURES = 1000
+
+
+class IngestQueue(object):
+    def __init__(self, max_docs=1000, max_delay=1.0, max_queued=None, local=False):
+        """ Flush every max_docs fingerprints or max_delay seconds. submit()
+            blocks while max_queued (by default 10 batches) are waiting. """
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.max_queued = max_queued or 10 * max_docs
+        self.local = local
+        self.flushes = 0
+        self.flushed = 0
+        self.last_flush = None
+        self.last_error = None
+        self._cond = threading.Condition()
+        self._queue = deque() # (time queued, fingerprint)
+        self._next_ticket = 1
+        # Tickets are flushed in order, so these are all the state they need
+        self._flushing_through = 0
+        self._done_through = 0
+        self._flush_through = 0 # asked for by flush()
+        self._failures = deque() # (first ticket, last ticket, error), in ticket order
+        # Tickets up to this one may have failed in a flush that has been forgotten
+        self._forgotten_through = 0
+        self._closed = False
+        self._thread = None
+
+    def submit(self, fingerprint):
+        """ Queue a fingerprint, as taken by fp.ingest, and return its ticket.
+            Raises ValueError if fp.ingest can't take it. """
+        fp.check_fingerprint(fingerprint)
+        if isinstance(fingerprint["fp"], basestring):
+            # Parse it now, so a bad code string is refused rather than queued
+            fingerprint = dict(fingerprint)
+            fingerprint["fp"] = fp.Codes.from_string(fingerprint["fp"])
+        with self._cond:
+            while len(self._queue) >= self.max_queued and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise ValueError("the ingest queue is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ingest queue")
+                self._thread.daemon = True
+                self._thread.start()
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._queue.append((time.time(), fingerprint))
+            if len(self._queue) == 1 or len(self._queue) >= self.max_docs:
+                self._cond.notify_all()
+        return ticket
+
+    def status(self, ticket):
+        """ {"ticket": ticket, "status": one of the states above}, with an
+            "error" for failed tickets """
+        with self._cond:
+            return self._status(ticket)
+
+    def wait(self, ticket, timeout=None):
+        """ Wait until ticket has been flushed, or for timeout seconds, and
+            return its status """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while self._done_through < ticket < self._next_ticket:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._status(ticket)
+
+    def flush(self, timeout=None):
+        """ Flush everything queued so far without waiting for the
+            thresholds, and wait for it """
+        with self._cond:
+            ticket = self._next_ticket - 1
+            self._flush_through = max(self._flush_through, ticket)
+            self._cond.notify_all()
+        return self.wait(ticket, timeout)
+
+    def close(self, timeout=None):
+        """ Flush what is queued and stop the background thread """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {"queued": len(self._queue), "flushes": self.flushes, "flushed": self.flushed,
+                    "last_ticket": self._next_ticket - 1, "committed_through": self._done_through,
+                    "last_flush": self.last_flush, "last_error": self.last_error}
+
+    def _status(self, ticket):
+        status = {"ticket": ticket}
+        if ticket < 1 or ticket >= self._next_ticket:
+            status["status"] = UNKNOWN
+        elif ticket <= self._forgotten_through:
+            status["status"] = UNKNOWN
+        elif ticket <= self._done_through:
+            status["status"] = COMMITTED
+            for (first, last, error) in self._failures:
+                if first <= ticket <= last:
+                    (status["status"], status["error"]) = (FAILED, error)
+                    break
+        elif ticket <= self._flushing_through:
+            status["status"] = FLUSHING
+        else:
+            status["status"] = QUEUED
+        return status
+
+    def _due(self):
+        if not self._queue:
+            return False
+        return (len(self._queue) >= self.max_docs or self._closed
+                or self._flush_through > self._flushing_through
+                or time.time() - self._queue[0][0] >= self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._queue:
+                        timeout = self._queue[0][0] + self.max_delay - time.time()
+                    self._cond.wait(timeout)
+                batch = [self._queue.popleft()[1] for i in xrange(min(self.max_docs, len(self._queue)))]
+                first = self._flushing_through + 1
+                self._flushing_through += len(batch)
+                last = self._flushing_through
+                # Wake submitters blocked on a full queue
+                self._cond.notify_all()
+
+            failures = self._ingest(batch, first)
+            flushed = len(batch) - sum(l - f + 1 for (f, l, error) in failures)
+            if flushed and not self.local:
+                try:
+                    fp.commit()
+                except Exception, e:
+                    logger.exception("committing ingest tickets %d to %d failed" % (first, last))
+                    failures = [(first, last, "%s: %s" % (e.__class__.__name__, e))]
+                    flushed = 0
+
+            with self._cond:
+                self._done_through = last
+                self.flushes += 1
+                self.last_flush = time.time()
+                self.flushed += flushed
+                for failure in failures:
+                    self._failures.append(failure)
+                    self.last_error = failure[2]
+                while len(self._failures) > MAX_FAILURES:
+                    self._forgotten_through = self._failures.popleft()[1]
+                self._cond.notify_all()
+
+    def _ingest(self, batch, first):
+        """ Write batch, whose tickets start at first, and return the
+            (first ticket, last ticket, error) of the fingerprints that
+            failed. A batch that fails is split in two and each half
+            written again, down to single fingerprints. """
+        try:
+            fp.ingest(batch, do_commit=False, local=self.local)
+            return []
+        except Exception, e:
+            if len(batch) == 1:
+                logger.exception("ingesting ticket %d failed" % first)
+                return [(first, first, "%s: %s" % (e.__class__.__name__, e))]
+            logger.warning("ingesting tickets %d to %d failed, retrying them in halves: %s"
+                           % (first, first + len(batch) - 1, e))
+        half = len(batch) // 2
+        return self._ingest(batch[:half], first) + self._ingest(batch[half:], first + half)
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+localindex.py
+
+The in-memory index behind fp's local mode. Track ids are given integer
+ordinals and the index is two flat arrays in CSR layout. Hash codes are 20
+bits (5 hex digits in a compressed code), so offsets has one slot per possible
+hash and postings[offsets[h]:offsets[h+1]] are the ordinals of the tracks that
+contain hash h. Looking up a hash is just indexing, and query candidates are
+counted with bincount over the ordinals instead of per-track dict lookups.
+
+An index can be saved to a single binary file and opened again with mmap.
+Opening doesn't read the file: the arrays are views of the mapping, so it
+takes constant time and processes that open the same file share its pages.
+The file is a header followed by 8 byte aligned sections (little endian):
+
+    magic "EPINDEX\\0", version (uint32), section count (uint32)
+    per section: name (8 bytes), offset (uint64), size in bytes (uint64)
+
+    offsets   int64[2^20 + 1]   CSR offsets into postings
+    postings  int32[]           track ordinals
+    codes     uint32[]          every track's hash codes, by ordinal
+    times     int32[]           and their times
+    codeoffs  int64[n + 1]      track o is codes[codeoffs[o]:codeoffs[o+1]]
+    ids       bytes             utf-8 track ids, back to back
+    idoffs    int64[n + 1]      track o's id is ids[idoffs[o]:idoffs[o+1]]
+    idorder   int32[n]          ordinals sorted by track id
+    meta      bytes             a JSON object of metadata per track
+    metaoffs  int64[n + 1]
+    stamp     bytes             8 random bytes identifying this snapshot
+
+Tracks added since the posting arrays were built are indexed in a small
+delta (hash -> ordinals) that queries search alongside them. The delta is
+merged into the arrays only once it holds DELTA_RATIO of their postings, so
+adding a track doesn't rebuild the index and an opened snapshot's postings
+stay shared until a lot has been added to it.
+
+Deleting a track only tombstones its ordinal: queries ignore its postings
+until enough of them are dead (GARBAGE_RATIO) for the posting arrays to be
+compacted. The forward index (track -> hashes) says how many postings each
+delete leaves behind.
+
+Tracks added or deleted after opening are held in memory on top of the file.
+Saving back to the same file doesn't rewrite it: the adds and deletes since
+the last save are appended to a journal next to it (filename + ".journal"),
+which open() replays. Once the journal outgrows COMPACT_RATIO of the snapshot
+the next save compacts both into a new snapshot and removes the journal.
+The journal is a header and then one record per operation:
+
+    magic "EPJRNL\0\0", the stamp of the snapshot it applies to (8 bytes)
+    per record: type (uint8), payload size (uint32), crc32 of payload (uint32)
+
+    add       header size (uint32), JSON {"track_id", "metadata"},
+              uint32 codes, int32 times
+    delete    JSON {"track_ids", "prefix"}
+
+A journal whose stamp doesn't match its snapshot is left over from before a
+compaction and is ignored. Replay stops at a torn or corrupt record.
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import os
+import mmap
+import struct
+import zlib
+import logging
+import itertools
+import numpy
+from collections import defaultdict
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+HASH_BITS = 20
+HASH_SPACE = 1 << HASH_BITS
+HASH_DTYPE = numpy.uint32
+ORDINAL_DTYPE = numpy.int32
+
+MAGIC = "EPINDEX\0"
+VERSION = 1
+_HEADER = struct.Struct("<8sII")
+_SECTION = struct.Struct("<8sQQ")
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_MAGIC = "EPJRNL\0\0"
+_JOURNAL_HEADER = struct.Struct("<8s8s")
+_RECORD = struct.Struct("<BII")
+_ADD = 1
+_DELETE = 2
+
+# Compact when the journal is bigger than this fraction of the snapshot
+COMPACT_RATIO = 0.5
+# Drop deleted tracks' postings when they are this fraction of all postings
+GARBAGE_RATIO = 0.25
+# Merge added postings into the posting arrays when they are this fraction of
+# them (or DELTA_MIN, whichever is more)
+DELTA_RATIO = 0.1
+DELTA_MIN = 100000
+
+logger = logging.getLogger(__name__)
+
+_SECTION_TYPES = [
+    ("offsets", numpy.int64),
+    ("postings", ORDINAL_DTYPE),
+    ("codes", HASH_DTYPE),
+    ("times", numpy.int32),
+    ("codeoffs", numpy.int64),
+    ("ids", None),
+    ("idoffs", numpy.int64),
+    ("idorder", ORDINAL_DTYPE),
+    ("meta", None),
+    ("metaoffs", numpy.int64),
+    ("stamp", None),
+]
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+class LocalIndex(object):
+    def __init__(self):
+        # The tracks of a saved index file, or None. Their ordinals are 0..len(snapshot)-1.
+        self._snapshot = None
+
+        # Tracks added since the snapshot; their ordinals follow the snapshot's
+        self._added_ids = []
+        self._ordinals = {}
+        self._store = {}
+        self._metadata = {}
+        # track id -> ids of its added segments (track_id-0, track_id-1, ...)
+        self._segments = defaultdict(set)
+
+        # Ordinals (of either kind) that have been deleted
+        self._dead = set()
+        self._count = 0
+        # Deleted ordinals whose postings haven't been compacted away yet,
+        # and how many postings they have
+        self._tombstones = set()
+        self._garbage = 0
+        # Forward index of added tracks: ordinal -> its unique hashes
+        self._forward = {}
+
+        # _postings[_offsets[h]:_offsets[h+1]] are the ordinals of the
+        # tracks that contain hash h
+        self._offsets = numpy.zeros(HASH_SPACE + 1, dtype=numpy.int64)
+        self._postings = numpy.zeros(0, dtype=ORDINAL_DTYPE)
+
+        # Postings added since the last merge: hash -> ordinals
+        self._delta = defaultdict(list)
+        self._delta_size = 0
+
+        # The file this index was opened from or last saved to, and the
+        # operations since then that its journal doesn't have yet
+        self._filename = None
+        self._stamp = None
+        self._journal_size = 0
+        self._unsaved = []
+
+    @classmethod
+    def open(cls, filename):
+        """ Open an index saved with save(). The file is mapped read only
+            and its journal, if any, is replayed. """
+        index = cls()
+        index._snapshot = _Snapshot(filename)
+        index._count = len(index._snapshot)
+        index._offsets = index._snapshot.offsets
+        index._postings = index._snapshot.postings
+        index._filename = filename
+        index._stamp = index._snapshot.stamp
+        if index._stamp is not None:
+            index._replay(filename + JOURNAL_SUFFIX)
+        return index
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, track_id):
+        return self._ordinal(track_id) is not None
+
+    def track_ids(self):
+        """ Iterate over the ids of all the tracks in the index """
+        for o in xrange(self._snapshot_size()):
+            if o not in self._dead:
+                yield self._snapshot.track_id(o)
+        for track_id in self._added_ids:
+            if track_id is not None:
+                yield track_id
+
+    def codes(self, track_id):
+        """ The (codes, times) arrays of a track """
+        if track_id in self._store:
+            return self._store[track_id]
+        return self._snapshot.track_codes(self._snapshot_ordinal(track_id))
+
+    def metadata(self, track_id):
+        """ The metadata dict of a track """
+        if track_id in self._metadata:
+            return self._metadata[track_id]
+        return self._snapshot.track_metadata(self._snapshot_ordinal(track_id))
+
+    def add(self, track_id, codes, times, metadata):
+        """ Index a track. codes and times are parallel integer arrays.
+            A track that is already in the index is replaced. """
+        hashes = numpy.unique(numpy.asarray(codes, dtype=HASH_DTYPE)) # just one code indexed
+        if len(hashes) and hashes[-1] >= HASH_SPACE:
+            raise ValueError("hash code %d of %s is more than %d bits" % (hashes[-1], track_id, HASH_BITS))
+        self._unsaved.append((_ADD, (track_id, codes, times, metadata)))
+        if track_id in self:
+            self._delete([track_id], prefix=False)
+        ordinal = self._next_ordinal()
+        self._added_ids.append(track_id)
+        self._ordinals[track_id] = ordinal
+        self._store[track_id] = (codes, times)
+        self._metadata[track_id] = metadata
+        self._segments[track_id.rsplit("-", 1)[0]].add(track_id)
+        self._forward[ordinal] = hashes
+        self._count += 1
+
+        for h in hashes.tolist():
+            self._delta[h].append(ordinal)
+        self._delta_size += len(hashes)
+        if self._delta_size > max(DELTA_MIN, DELTA_RATIO * len(self._postings)):
+            self._merge()
+
+    def delete(self, track_ids, prefix=True):
+        """ Remove tracks from the index. With prefix, a track id also removes
+            all of its segments (track_id-0, track_id-1, ...). """
+        track_ids = list(track_ids)
+        self._unsaved.append((_DELETE, (track_ids, prefix)))
+        self._delete(track_ids, prefix)
+
+    def _delete(self, track_ids, prefix):
+        doomed = set()
+        for track_id in track_ids:
+            ordinal = self._ordinal(track_id)
+            if ordinal is not None:
+                doomed.add(ordinal)
+            if prefix:
+                doomed.update(self._ordinals[t] for t in self._segments.get(track_id, ()))
+                if self._snapshot is not None:
+                    doomed.update(o for o in self._snapshot.prefixed(track_id + "-") if o not in self._dead)
+        for ordinal in doomed:
+            self._garbage += len(self._hashes(ordinal))
+            track_id = self._track_id(ordinal)
+            if ordinal >= self._snapshot_size():
+                del self._ordinals[track_id]
+                del self._store[track_id]
+                del self._metadata[track_id]
+                self._added_ids[ordinal - self._snapshot_size()] = None
+                base = track_id.rsplit("-", 1)[0]
+                self._segments[base].discard(track_id)
+                if not self._segments[base]:
+                    del self._segments[base]
+                del self._forward[ordinal]
+            self._dead.add(ordinal)
+            self._tombstones.add(ordinal)
+            self._count -= 1
+
+        total = len(self._postings) + self._delta_size
+        if self._garbage > GARBAGE_RATIO * total:
+            self._compact()
+
+    def query(self, codes, rows=10):
+        """ Return up to rows (track_id, score) pairs for the tracks sharing the
+            most unique hash codes with codes, best first. """
+        hashes = numpy.unique(numpy.asarray(codes, dtype=HASH_DTYPE))
+        ordinals = self._candidates(hashes[hashes < HASH_SPACE])
+        if not len(ordinals):
+            return []
+        counts = numpy.bincount(ordinals)
+        if self._tombstones:
+            tombstones = numpy.fromiter(self._tombstones, dtype=numpy.int64, count=len(self._tombstones))
+            counts[tombstones[tombstones < len(counts)]] = 0
+        candidates = numpy.flatnonzero(counts)
+        if len(candidates) > rows:
+            # Everything tied with the rows-th best score is a candidate
+            threshold = numpy.partition(counts[candidates], len(candidates) - rows)[len(candidates) - rows]
+            candidates = candidates[counts[candidates] >= threshold]
+        matches = [(self._track_id(o), int(counts[o])) for o in candidates]
+        matches.sort(key=lambda (k, v): (v, k), reverse=True)
+        return matches[:rows]
+
+    def hashes(self):
+        """ The hashes that are in at least one track """
+        self._compact()
+        return numpy.flatnonzero(numpy.diff(self._offsets)).astype(HASH_DTYPE)
+
+    def postings(self):
+        """ Iterate over (hash, [track_id, ...]) for every indexed hash """
+        self._compact()
+        for h in numpy.flatnonzero(numpy.diff(self._offsets)).tolist():
+            ordinals = self._postings[self._offsets[h]:self._offsets[h+1]]
+            yield (h, [self._track_id(o) for o in ordinals])
+
+    def save(self, filename, compact=False):
+        """ Save the index to filename. If the index was opened from or last
+            saved to filename, the changes since then are appended to its
+            journal; otherwise, or with compact, or once the journal has
+            grown too big, a whole new snapshot is written. """
+        if not compact and filename == self._filename and self._stamp is not None:
+            if self._journal_size <= COMPACT_RATIO * os.path.getsize(filename):
+                self._append_journal(filename + JOURNAL_SUFFIX)
+                return
+        self._write_snapshot(filename)
+
+    def _write_snapshot(self, filename):
+        """ Write the index to filename in the mmap-able format described at
+            the top of this module. Deleted tracks are dropped and the
+            remaining tracks get new, dense ordinals. """
+        self._compact()
+        live = numpy.ones(self._next_ordinal(), dtype=bool)
+        live[list(self._dead)] = False
+        renumber = (numpy.cumsum(live) - 1).astype(ORDINAL_DTYPE)
+
+        ids = []
+        metas = []
+        codes = []
+        times = []
+        for o in numpy.flatnonzero(live).tolist():
+            track_id = self._track_id(o)
+            (c, t) = self.codes(track_id)
+            codes.append(numpy.asarray(c, dtype=HASH_DTYPE))
+            times.append(numpy.asarray(t, dtype=numpy.int32))
+            metas.append(json.dumps(self.metadata(track_id)))
+            if isinstance(track_id, unicode):
+                track_id = track_id.encode("utf-8")
+            ids.append(track_id)
+
+        sections = {
+            "offsets": self._offsets,
+            "postings": renumber[self._postings],
+            "codes": numpy.concatenate([numpy.zeros(0, dtype=HASH_DTYPE)] + codes),
+            "times": numpy.concatenate([numpy.zeros(0, dtype=numpy.int32)] + times),
+            "codeoffs": _lengths_to_offsets([len(c) for c in codes]),
+            "ids": "".join(ids),
+            "idoffs": _lengths_to_offsets([len(i) for i in ids]),
+            "idorder": numpy.array(sorted(xrange(len(ids)), key=ids.__getitem__), dtype=ORDINAL_DTYPE),
+            "meta": "".join(metas),
+            "metaoffs": _lengths_to_offsets([len(m) for m in metas]),
+            "stamp": os.urandom(8),
+        }
+        _write_sections(filename, sections)
+        # The new snapshot has everything, so an old journal is now stale
+        # (and ignored if removing it fails)
+        if os.path.exists(filename + JOURNAL_SUFFIX):
+            os.remove(filename + JOURNAL_SUFFIX)
+        self._filename = filename
+        self._stamp = sections["stamp"]
+        self._journal_size = 0
+        self._unsaved = []
+
+    def _append_journal(self, journal):
+        """ Append the unsaved operations to journal """
+        if not self._unsaved and self._journal_size:
+            return
+        with open(journal, "ab") as f:
+            # Drop a torn record left by a crash, or start a new journal
+            f.truncate(self._journal_size)
+            f.seek(self._journal_size)
+            if not self._journal_size:
+                f.write(_JOURNAL_HEADER.pack(JOURNAL_MAGIC, self._stamp))
+            for (kind, args) in self._unsaved:
+                payload = _encode_record(kind, *args)
+                f.write(_RECORD.pack(kind, len(payload), zlib.crc32(payload) & 0xffffffff))
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+            self._journal_size = f.tell()
+        self._unsaved = []
+
+    def _replay(self, journal):
+        """ Apply the operations in journal, if it belongs to the snapshot """
+        if not os.path.exists(journal):
+            return
+        with open(journal, "rb") as f:
+            data = f.read()
+        if len(data) < _JOURNAL_HEADER.size:
+            return
+        (magic, stamp) = _JOURNAL_HEADER.unpack_from(data, 0)
+        if magic != JOURNAL_MAGIC or stamp != self._stamp:
+            logger.warning("ignoring %s, it doesn't belong to this index" % journal)
+            return
+        position = _JOURNAL_HEADER.size
+        while position + _RECORD.size <= len(data):
+            (kind, size, crc) = _RECORD.unpack_from(data, position)
+            payload = data[position + _RECORD.size:position + _RECORD.size + size]
+            if len(payload) < size or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            if kind == _ADD:
+                self.add(*_decode_add(payload))
+            elif kind == _DELETE:
+                record = json.loads(payload)
+                self.delete(record["track_ids"], record["prefix"])
+            else:
+                break
+            position += _RECORD.size + size
+        if position < len(data):
+            logger.warning("%s is damaged after %d bytes, ignoring the rest" % (journal, position))
+        self._journal_size = position
+        self._unsaved = []
+
+    def _snapshot_size(self):
+        if self._snapshot is None:
+            return 0
+        return len(self._snapshot)
+
+    def _next_ordinal(self):
+        return self._snapshot_size() + len(self._added_ids)
+
+    def _track_id(self, ordinal):
+        if ordinal < self._snapshot_size():
+            return self._snapshot.track_id(ordinal)
+        return self._added_ids[ordinal - self._snapshot_size()]
+
+    def _ordinal(self, track_id):
+        """ The ordinal of a live track, or None """
+        if track_id in self._ordinals:
+            return self._ordinals[track_id]
+        if self._snapshot is not None:
+            ordinal = self._snapshot.find(track_id)
+            if ordinal is not None and ordinal not in self._dead:
+                return ordinal
+        return None
+
+    def _snapshot_ordinal(self, track_id):
+        ordinal = self._ordinal(track_id)
+        if ordinal is None or ordinal >= self._snapshot_size():
+            raise KeyError(track_id)
+        return ordinal
+
+    def _hashes(self, ordinal):
+        """ The unique hashes of a live track, from the forward index """
+        if ordinal in self._forward:
+            return self._forward[ordinal]
+        return numpy.unique(self._snapshot.track_codes(ordinal)[0])
+
+    def _candidates(self, hashes):
+        """ The concatenated posting lists of hashes """
+        starts = self._offsets[hashes]
+        lengths = self._offsets[hashes + 1] - starts
+        # Each posting's position is the start of its run plus its place in the run
+        run_starts = numpy.cumsum(lengths) - lengths
+        positions = numpy.repeat(starts - run_starts, lengths) + numpy.arange(lengths.sum())
+        ordinals = self._postings[positions]
+        if self._delta:
+            added = [self._delta[h] for h in hashes.tolist() if h in self._delta]
+            if added:
+                added = numpy.fromiter(itertools.chain(*added), dtype=ORDINAL_DTYPE)
+                ordinals = numpy.concatenate((ordinals, added))
+        return ordinals
+
+    def _merge(self):
+        """ Fold the delta into the sorted posting arrays """
+        if not self._delta:
+            return
+        delta_hashes = numpy.fromiter(self._delta.iterkeys(), dtype=HASH_DTYPE, count=len(self._delta))
+        lengths = numpy.fromiter((len(o) for o in self._delta.itervalues()), dtype=numpy.int64, count=len(self._delta))
+        delta_ordinals = numpy.fromiter(itertools.chain(*self._delta.itervalues()), dtype=ORDINAL_DTYPE, count=self._delta_size)
+        hashes = numpy.concatenate((self._posting_hashes(), numpy.repeat(delta_hashes, lengths)))
+        ordinals = numpy.concatenate((self._postings, delta_ordinals))
+        self._delta = defaultdict(list)
+        self._delta_size = 0
+        order = numpy.argsort(hashes, kind="mergesort")
+        self._set_postings(hashes[order], ordinals[order])
+
+    def _compact(self):
+        """ Merge the delta and drop the postings of deleted tracks """
+        self._merge()
+        if not self._tombstones:
+            return
+        dead = numpy.zeros(self._next_ordinal(), dtype=bool)
+        dead[list(self._tombstones)] = True
+        keep = ~dead[self._postings]
+        self._set_postings(self._posting_hashes()[keep], self._postings[keep])
+        self._tombstones = set()
+        self._garbage = 0
+
+    def _posting_hashes(self):
+        """ The hash of each entry in _postings """
+        return numpy.repeat(numpy.arange(HASH_SPACE, dtype=HASH_DTYPE), numpy.diff(self._offsets))
+
+    def _set_postings(self, hashes, ordinals):
+        """ Rebuild the posting arrays from parallel hash-sorted arrays """
+        self._offsets = numpy.zeros(HASH_SPACE + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(hashes, minlength=HASH_SPACE), out=self._offsets[1:])
+        self._postings = ordinals.astype(ORDINAL_DTYPE)
+
+
+class _Snapshot(object):
+    """ The read only arrays of an index file, as views of an mmap """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, nsections) = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise IndexFormatError("%s is not a local index file" % filename)
+        if version != VERSION:
+            raise IndexFormatError("%s is version %d, expected %d" % (filename, version, VERSION))
+
+        self._sections = {}
+        for i in range(nsections):
+            (name, offset, size) = _SECTION.unpack_from(self._mm, _HEADER.size + i * _SECTION.size)
+            self._sections[name.rstrip("\0")] = (offset, size)
+        for (name, dtype) in _SECTION_TYPES:
+            if dtype is not None:
+                setattr(self, name, self._array(name, dtype))
+        if len(self.offsets) != HASH_SPACE + 1:
+            raise IndexFormatError("%s was written for a different hash size" % filename)
+        # Files saved before journaling have no stamp, and can't be journaled to
+        self.stamp = None
+        if "stamp" in self._sections:
+            (offset, size) = self._sections["stamp"]
+            self.stamp = self._mm[offset:offset + size]
+
+    def __len__(self):
+        return len(self.idorder)
+
+    def _array(self, name, dtype):
+        dtype = numpy.dtype(dtype).newbyteorder("<")
+        (offset, size) = self._sections[name]
+        if size == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.frombuffer(self._mm, dtype=dtype, count=size / dtype.itemsize, offset=offset)
+
+    def _bytes(self, name, offsets, i):
+        start = self._sections[name][0]
+        return self._mm[start + offsets[i]:start + offsets[i+1]]
+
+    def track_id(self, ordinal):
+        return self._bytes("ids", self.idoffs, ordinal)
+
+    def track_codes(self, ordinal):
+        (start, end) = self.codeoffs[ordinal:ordinal+2]
+        return (self.codes[start:end], self.times[start:end])
+
+    def track_metadata(self, ordinal):
+        return json.loads(self._bytes("meta", self.metaoffs, ordinal))
+
+    def _search(self, track_id):
+        """ Position in idorder of the first track id >= track_id """
+        (lo, hi) = (0, len(self.idorder))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.track_id(self.idorder[mid]) < track_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, track_id):
+        """ The ordinal of track_id, or None """
+        if isinstance(track_id, unicode):
+            track_id = track_id.encode("utf-8")
+        i = self._search(track_id)
+        if i < len(self.idorder) and self.track_id(self.idorder[i]) == track_id:
+            return int(self.idorder[i])
+        return None
+
+    def prefixed(self, prefix):
+        """ The ordinals of all the track ids starting with prefix """
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode("utf-8")
+        i = self._search(prefix)
+        while i < len(self.idorder) and self.track_id(self.idorder[i]).startswith(prefix):
+            yield int(self.idorder[i])
+            i += 1
+
+
+def _encode_record(kind, *args):
+    if kind == _ADD:
+        (track_id, codes, times, metadata) = args
+        header = json.dumps({"track_id": track_id, "metadata": metadata})
+        codes = numpy.asarray(codes, dtype=numpy.dtype(HASH_DTYPE).newbyteorder("<"))
+        times = numpy.asarray(times, dtype=numpy.dtype(numpy.int32).newbyteorder("<"))
+        return struct.pack("<I", len(header)) + header + codes.tostring() + times.tostring()
+    (track_ids, prefix) = args
+    return json.dumps({"track_ids": track_ids, "prefix": prefix})
+
+def _decode_add(payload):
+    (size,) = struct.unpack_from("<I", payload, 0)
+    header = json.loads(payload[4:4 + size])
+    count = (len(payload) - 4 - size) // 8
+    codes = numpy.frombuffer(payload, dtype=numpy.dtype(HASH_DTYPE).newbyteorder("<"), count=count, offset=4 + size)
+    times = numpy.frombuffer(payload, dtype=numpy.dtype(numpy.int32).newbyteorder("<"), count=count, offset=4 + size + 4 * count)
+    return (header["track_id"], codes, times, header["metadata"])
+
+def _lengths_to_offsets(lengths):
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def _write_sections(filename, sections):
+    """ Write sections to filename, atomically replacing it """
+    header_size = _HEADER.size + len(_SECTION_TYPES) * _SECTION.size
+    table = []
+    position = header_size
+    for (name, dtype) in _SECTION_TYPES:
+        position += -position % 8
+        data = sections[name]
+        if dtype is not None:
+            data = numpy.asarray(data, dtype=numpy.dtype(dtype).newbyteorder("<"))
+        table.append((name, position, data))
+        position += len(data) if dtype is None else data.nbytes
+
+    tmpname = filename + ".tmp"
+    with open(tmpname, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(table)))
+        for (name, offset, data) in table:
+            f.write(_SECTION.pack(name, offset, len(data) if isinstance(data, str) else data.nbytes))
+        for (name, offset, data) in table:
+            f.write("\0" * (offset - f.tell()))
+            if isinstance(data, str):
+                f.write(data)
+            else:
+                data.tofile(f)
+    os.rename(tmpname, filename)
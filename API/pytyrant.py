@@ -22,16 +22,35 @@ for the raw Tyrant protocol::
     foobar
     >>> del t['__test_key__']
 
+PooledPyTyrant is the same dict-like wrapper over a thread-safe pool of
+connections, for sharing one client between threads::
+
+    >>> t = pytyrant.PooledPyTyrant.open('127.0.0.1', 1978, pool_size=8)
+
+A pipeline sends several commands back to back and then reads their
+replies, paying for one round trip instead of one per command::
+
+    >>> p = t.pipeline()
+    >>> p = p.put('__test_a__', 'foo').put('__test_b__', 'bar').get('__test_a__')
+    >>> p = p.misc('getlist', 0, ['__test_a__', '__test_b__'])
+    >>> p.execute()
+    [None, None, 'foo', ['__test_a__', 'foo', '__test_b__', 'bar']]
+    >>> del t['__test_a__'], t['__test_b__']
+
 """
 import math
 import socket
 import struct
+import select
+import Queue
 import UserDict
+from contextlib import contextmanager
 
 __version__ = '1.1.17'
 
 __all__ = [
-    'Tyrant', 'TyrantError', 'PyTyrant',
+    'Tyrant', 'TyrantError', 'TyrantConnectionError', 'PyTyrant',
+    'TyrantPool', 'PooledPyTyrant', 'Pipeline',
     'RDBMONOULOG', 'RDBXOLCKREC', 'RDBXOLCKGLB',
 ]
 
@@ -39,9 +58,18 @@ class TyrantError(Exception):
     pass
 
 
+class TyrantConnectionError(TyrantError):
+    pass
+
+
 DEFAULT_PORT = 1978
 MAGIC = 0xc8
 
+# A pipeline sends at most this many bytes of commands before reading their
+# replies. While we're sending, the server can be blocked writing replies we
+# haven't read yet; a window that fits in the socket buffers can't deadlock.
+PIPELINE_WINDOW = 64 * 1024
+
 
 RDBMONOULOG = 1 << 0
 RDBXOLCKREC = 1 << 0
@@ -156,14 +184,59 @@ def socksend(sock, lst):
     sock.sendall(''.join(lst))
 
 
+class SockBuffer(object):
+    """
+    Buffered reads from a socket. Data is received straight into one
+    reusable bytearray, as much as the socket has at a time, so a reply made
+    of many small fields takes a few recv calls rather than one per field.
+    """
+    def __init__(self, sock, size=64 * 1024):
+        self.sock = sock
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        "The number of bytes received but not read yet."
+        return self._end - self._start
+
+    def read(self, bytes):
+        if self._end - self._start < bytes:
+            self._fill(bytes)
+        d = memoryview(self._buf)[self._start:self._start + bytes].tobytes()
+        self._start += bytes
+        return d
+
+    def _fill(self, bytes):
+        pending = self._end - self._start
+        if bytes > len(self._buf):
+            buf = bytearray(max(bytes, 2 * len(self._buf)))
+            buf[:pending] = self._buf[self._start:self._end]
+            self._buf = buf
+            (self._start, self._end) = (0, pending)
+        elif self._start + bytes > len(self._buf):
+            self._buf[:pending] = self._buf[self._start:self._end]
+            (self._start, self._end) = (0, pending)
+        view = memoryview(self._buf)
+        while self._end - self._start < bytes:
+            n = self.sock.recv_into(view[self._end:])
+            if not n:
+                raise TyrantConnectionError('Connection closed')
+            self._end += n
+
+
 def sockrecv(sock, bytes):
-    d = ''
-    while len(d) < bytes:
-        c = sock.recv(min(8192, bytes - len(d)))
-        if not c:
-            raise TyrantError('Connection closed')
-        d += c
-    return d
+    if isinstance(sock, SockBuffer):
+        return sock.read(bytes)
+    d = bytearray(bytes)
+    view = memoryview(d)
+    received = 0
+    while received < bytes:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise TyrantConnectionError('Connection closed')
+        received += n
+    return str(d)
 
 
 def socksuccess(sock):
@@ -335,6 +408,9 @@ class PyTyrant(object, UserDict.DictMixin):
     def sync(self):
         self.t.sync()
 
+    def pipeline(self):
+        return self.t.pipeline()
+
     def close(self):
         self.t.close()
 
@@ -349,28 +425,35 @@ class Tyrant(object):
 
     def __init__(self, sock):
         self.sock = sock
+        # Replies are read through buf; everything is sent on sock
+        self.buf = SockBuffer(sock)
 
     def close(self):
         self.sock.close()
 
+    def pipeline(self):
+        """Start a Pipeline of commands to send to this server together
+        """
+        return Pipeline(self)
+
     def put(self, key, value):
         """Unconditionally set key to value
         """
         socksend(self.sock, _t2(C.put, key, value))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def putkeep(self, key, value):
         """Set key to value if key does not already exist
         """
         socksend(self.sock, _t2(C.putkeep, key, value))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def putcat(self, key, value):
         """Append value to the existing value for key, or set key to
         value if it does not already exist
         """
         socksend(self.sock, _t2(C.putcat, key, value))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def putshl(self, key, value, width):
         """Equivalent to::
@@ -379,7 +462,7 @@ class Tyrant(object):
             self.put(key, self.get(key)[-width:])
         """
         socksend(self.sock, _t2W(C.putshl, key, value, width))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def putnr(self, key, value):
         """Set key to value without waiting for a server response
@@ -390,54 +473,58 @@ class Tyrant(object):
         """Remove key from server
         """
         socksend(self.sock, _t1(C.out, key))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def get(self, key):
         """Get the value of a key from the server
         """
         socksend(self.sock, _t1(C.get, key))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        return self._get_reply()
 
-    def _mget(self, klst):
-        socksend(self.sock, _tN(C.mget, klst))
-        socksuccess(self.sock)
-        numrecs = socklen(self.sock)
-        for i in xrange(numrecs):
-            k, v = sockstrpair(self.sock)
-            yield k, v
+    def _get_reply(self):
+        socksuccess(self.buf)
+        return sockstr(self.buf)
 
     def mget(self, klst):
         """Get key,value pairs from the server for the given list of keys
         """
-        return list(self._mget(klst))
+        socksend(self.sock, _tN(C.mget, klst))
+        return self._mget_reply()
+
+    def _mget_reply(self):
+        socksuccess(self.buf)
+        numrecs = socklen(self.buf)
+        return [sockstrpair(self.buf) for i in xrange(numrecs)]
 
     def vsiz(self, key):
         """Get the size of a value for key
         """
         socksend(self.sock, _t1(C.vsiz, key))
-        socksuccess(self.sock)
-        return socklen(self.sock)
+        return self._vsiz_reply()
+
+    def _vsiz_reply(self):
+        socksuccess(self.buf)
+        return socklen(self.buf)
 
     def iterinit(self):
         """Begin iteration over all keys of the database
         """
         socksend(self.sock, _t0(C.iterinit))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def iternext(self):
         """Get the next key after iterinit
         """
         socksend(self.sock, _t0(C.iternext))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.buf)
+        return sockstr(self.buf)
 
     def _fwmkeys(self, prefix, maxkeys):
         socksend(self.sock, _t1M(C.fwmkeys, prefix, maxkeys))
-        socksuccess(self.sock)
-        numkeys = socklen(self.sock)
+        socksuccess(self.buf)
+        numkeys = socklen(self.buf)
         for i in xrange(numkeys):
-            yield sockstr(self.sock)
+            yield sockstr(self.buf)
 
     def fwmkeys(self, prefix, maxkeys):
         """Get up to the first maxkeys starting with prefix
@@ -446,15 +533,15 @@ class Tyrant(object):
 
     def addint(self, key, num):
         socksend(self.sock, _t1M(C.addint, key, num))
-        socksuccess(self.sock)
-        return socklen(self.sock)
+        socksuccess(self.buf)
+        return socklen(self.buf)
 
     def adddouble(self, key, num):
         fracpart, intpart = math.modf(num)
         fracpart, intpart = int(fracpart * 1e12), int(intpart)
         socksend(self.sock, _tDouble(C.adddouble, key, fracpart, intpart))
-        socksuccess(self.sock)
-        return sockdouble(self.sock)
+        socksuccess(self.buf)
+        return sockdouble(self.buf)
 
     def ext(self, func, opts, key, value):
         # tcrdbext opts are RDBXOLCKREC, RDBXOLCKGLB
@@ -463,69 +550,66 @@ class Tyrant(object):
         opts is a bitflag that can be RDBXOLCKREC for record locking
         and/or RDBXOLCKGLB for global locking"""
         socksend(self.sock, _t3F(C.ext, func, opts, key, value))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.buf)
+        return sockstr(self.buf)
 
     def sync(self):
         """Synchronize the database
         """
         socksend(self.sock, _t0(C.sync))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def vanish(self):
         """Remove all records
         """
         socksend(self.sock, _t0(C.vanish))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def copy(self, path):
         """Hot-copy the database to path
         """
         socksend(self.sock, _t1(C.copy, path))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def restore(self, path, msec):
         """Restore the database from path at timestamp (in msec)
         """
         socksend(self.sock, _t1R(C.copy, path, msec))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def setmst(self, host, port):
         """Set master to host:port
         """
         socksend(self.sock, _t1M(C.setmst, host, port))
-        socksuccess(self.sock)
+        socksuccess(self.buf)
 
     def rnum(self):
         """Get the number of records in the database
         """
         socksend(self.sock, _t0(C.rnum))
-        socksuccess(self.sock)
-        return socklong(self.sock)
+        socksuccess(self.buf)
+        return socklong(self.buf)
 
     def size(self):
         """Get the size of the database
         """
         socksend(self.sock, _t0(C.size))
-        socksuccess(self.sock)
-        return socklong(self.sock)
+        socksuccess(self.buf)
+        return socklong(self.buf)
 
     def stat(self):
         """Get some statistics about the database
         """
         socksend(self.sock, _t0(C.stat))
-        socksuccess(self.sock)
-        return sockstr(self.sock)
+        socksuccess(self.buf)
+        return sockstr(self.buf)
 
-    def _misc(self, func, opts, args):
-        # tcrdbmisc opts are RDBMONOULOG
-        socksend(self.sock, _t1FN(C.misc, func, opts, args))
+    def _misc_reply(self):
         try:
-            socksuccess(self.sock)
+            socksuccess(self.buf)
         finally:
-            numrecs = socklen(self.sock)
-        for i in xrange(numrecs):
-            yield sockstr(self.sock)
+            numrecs = socklen(self.buf)
+        return [sockstr(self.buf) for i in xrange(numrecs)]
 
     def misc(self, func, opts, args):
         """All databases support "putlist", "outlist", and "getlist".
@@ -537,7 +621,248 @@ class Tyrant(object):
 
         opts is a bitflag that can be RDBMONOULOG to prevent writing to the update log
         """
-        return list(self._misc(func, opts, args))
+        # tcrdbmisc opts are RDBMONOULOG
+        socksend(self.sock, _t1FN(C.misc, func, opts, args))
+        return self._misc_reply()
+
+    def _success_reply(self):
+        socksuccess(self.buf)
+
+
+class Pipeline(object):
+    """
+    Commands queued up to be sent to a Tyrant together. Each command method
+    returns the pipeline, so calls can be chained. Nothing is sent until
+    execute().
+    """
+    def __init__(self, tyrant):
+        self.tyrant = tyrant
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _queue(self, request, reply):
+        self._commands.append((''.join(request), reply))
+        return self
+
+    def put(self, key, value):
+        return self._queue(_t2(C.put, key, value), Tyrant._success_reply)
+
+    def out(self, key):
+        return self._queue(_t1(C.out, key), Tyrant._success_reply)
+
+    def get(self, key):
+        return self._queue(_t1(C.get, key), Tyrant._get_reply)
+
+    def mget(self, klst):
+        return self._queue(_tN(C.mget, klst), Tyrant._mget_reply)
+
+    def vsiz(self, key):
+        return self._queue(_t1(C.vsiz, key), Tyrant._vsiz_reply)
+
+    def misc(self, func, opts, args):
+        return self._queue(_t1FN(C.misc, func, opts, args), Tyrant._misc_reply)
+
+    def execute(self, raise_on_error=True):
+        """
+        Send the queued commands and return their results, in order. A
+        command that fails (like a get of a missing key) doesn't stop the
+        others: its result is the TyrantError, and unless raise_on_error is
+        false the first such error is raised once every reply is read.
+        """
+        commands = self._commands
+        self._commands = []
+        return _check(self._execute(self.tyrant, commands), raise_on_error)
+
+    @staticmethod
+    def _execute(tyrant, commands):
+        results = []
+        start = 0
+        while start < len(commands):
+            # Send a window of commands, then read their replies
+            end = start + 1
+            size = len(commands[start][0])
+            while end < len(commands) and size + len(commands[end][0]) <= PIPELINE_WINDOW:
+                size += len(commands[end][0])
+                end += 1
+            socksend(tyrant.sock, [request for (request, reply) in commands[start:end]])
+            for (request, reply) in commands[start:end]:
+                try:
+                    results.append(reply(tyrant))
+                except TyrantConnectionError:
+                    raise
+                except TyrantError, e:
+                    results.append(e)
+            start = end
+        return results
+
+
+def _check(results, raise_on_error):
+    if raise_on_error:
+        for r in results:
+            if isinstance(r, TyrantError):
+                raise r
+    return results
+
+
+# Commands that are safe to send again when the connection broke before
+# their reply was read
+_IDEMPOTENT = frozenset([
+    'put', 'out', 'get', 'mget', 'vsiz', 'fwmkeys', 'sync', 'rnum', 'size',
+    'stat', 'misc',
+])
+
+
+class TyrantPool(object):
+    "Thread-safe pool of Tyrant connections."
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, pool_size=20):
+        """
+        Keep at most pool_size idle connections to host:port. More are
+        opened when every pooled connection is checked out.
+        """
+        self.host = host
+        self.port = port
+        self._queue = Queue.Queue(pool_size)
+
+    def get(self):
+        "Get a healthy connection, opening a new one if needed."
+        while True:
+            try:
+                t = self._queue.get_nowait()
+            except Queue.Empty:
+                return Tyrant.open(self.host, self.port)
+            if not len(t.buf) and _idle_ok(t.sock):
+                return t
+            t.close()
+
+    def put(self, t):
+        "Return a connection to the pool."
+        try:
+            self._queue.put_nowait(t)
+        except Queue.Full:
+            t.close()
+
+    def close(self):
+        "Close the idle connections."
+        while True:
+            try:
+                self._queue.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for a with block. It goes back in the pool
+        unless the block raised, when its state is unknown and it is closed.
+        """
+        t = self.get()
+        try:
+            yield t
+        except:
+            t.close()
+            raise
+        else:
+            self.put(t)
+
+    def call(self, name, *args):
+        """
+        Run a Tyrant command on a pooled connection. If the connection
+        turns out to be broken, an idempotent command is tried once more
+        on a new one.
+        """
+        retry = name in _IDEMPOTENT
+        while True:
+            t = self.get()
+            try:
+                result = getattr(t, name)(*args)
+            except (socket.error, TyrantConnectionError):
+                t.close()
+                if not retry:
+                    raise
+                retry = False
+                continue
+            except TyrantError:
+                # A failure reply; the connection is still in step
+                self.put(t)
+                raise
+            except:
+                t.close()
+                raise
+            self.put(t)
+            return result
+
+
+def _idle_ok(sock):
+    # An idle connection has nothing to read. If it's readable the server
+    # has closed it (or it's out of step) and it shouldn't be reused.
+    try:
+        readable = select.select([sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+
+class _PooledTyrant(object):
+    """
+    Stands in for a Tyrant, running each command on a pooled connection
+    """
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        def command(*args):
+            return self.pool.call(name, *args)
+        command.__name__ = name
+        return command
+
+    def pipeline(self):
+        return _PooledPipeline(self.pool)
+
+    def close(self):
+        self.pool.close()
+
+
+class _PooledPipeline(Pipeline):
+    """
+    A Pipeline that checks out a connection when it is executed
+    """
+    def __init__(self, pool):
+        Pipeline.__init__(self, None)
+        self.pool = pool
+
+    def execute(self, raise_on_error=True):
+        commands = self._commands
+        self._commands = []
+        with self.pool.connection() as t:
+            results = self._execute(t, commands)
+        return _check(results, raise_on_error)
+
+
+class PooledPyTyrant(PyTyrant):
+    """
+    Dict-like proxy for a pool of connections to a Tyrant instance. It can
+    be shared between threads: every command checks out its own connection.
+    """
+    @classmethod
+    def open(cls, host='127.0.0.1', port=DEFAULT_PORT, pool_size=20):
+        return cls(_PooledTyrant(TyrantPool(host, port, pool_size)))
+
+    def iterkeys(self):
+        # The iterator lives in the server's per-connection state, so
+        # iterinit and every iternext have to use the same connection
+        with self.t.pool.connection() as t:
+            t.iterinit()
+            while True:
+                try:
+                    key = t.iternext()
+                except TyrantConnectionError:
+                    raise
+                except TyrantError:
+                    break
+                yield key
 
 
 def main():
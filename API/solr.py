@@ -363,6 +363,7 @@ class ConnectionPool(object):
 class SolrConnectionPool(ConnectionPool):
     def __init__(self, url, **kwargs):
         ConnectionPool.__init__(self, SolrConnection, url, **kwargs)
+        self.url = url
 
     
 def str2bool(s):
@@ -613,7 +614,28 @@ class SolrConnection:
         Returns a Response instance.
 
         """
+        params = self.query_params(q, fields, highlight, score, sort,
+                                   use_experimental_parser, **params)
+        request = urllib.urlencode(params, doseq=True)
+        try:
+            rsp = self._post(self.path + '/select'+self.invariant, 
+                              request, self.form_headers)
+            # If we pass in rsp directly, instead of using rsp.read())
+            # and creating a StringIO, then Persistence breaks with
+            # an internal python error. 
+            data = self.parse_select(rsp.read(), params, use_experimental_parser)
+        finally:
+            if not self.persistent: 
+                self.conn.close()
+
+        return data
 
+    def query_params(self, q, fields=None, highlight=None, 
+              score=True, sort=None, use_experimental_parser=False, **params):
+        """
+        The parameters of the /select request for a query(). Takes the
+        same arguments.
+        """
        # Clean up optional parameters to match SOLR spec.
         params = dict([(key.replace('_','.'), unicode(value)) 
                       for key, value in params.items()])
@@ -662,33 +684,20 @@ class SolrConnection:
             params['wt']='python'
         else:
             params['wt'] = 'standard'
+        return params
 
-        request = urllib.urlencode(params, doseq=True)
-        try:
-            tic = time.time()
-            rsp = self._post(self.path + '/select'+self.invariant, 
-                              request, self.form_headers)
-            # If we pass in rsp directly, instead of using rsp.read())
-            # and creating a StringIO, then Persistence breaks with
-            # an internal python error. 
-            
-            #xml = StringIO(self._cleanup(reallyUTF8(rsp.read())))
-            tic=time.time()
-            s1 = rsp.read()
-            s2 = reallyUTF8(s1)
-            s3 = self._cleanup(s2)
-
-            if(use_experimental_parser):
-                data = self.parse_query_response_python(s3,  params=params, connection=self)
-            else:
-                xml = StringIO(s3)
-                data = self.parse_query_response(xml,  params=params, connection=self)                
-            
-        finally:
-            if not self.persistent: 
-                self.conn.close()
+    def parse_select(self, body, params, use_experimental_parser=False):
+        """
+        Parse the body of a /select response to the query with params.
+        """
+        s2 = reallyUTF8(body)
+        s3 = self._cleanup(s2)
 
-        return data
+        if(use_experimental_parser):
+            return self.parse_query_response_python(s3,  params=params, connection=self)
+        else:
+            xml = StringIO(s3)
+            return self.parse_query_response(xml,  params=params, connection=self)
 
 
     def begin_batch(self): 
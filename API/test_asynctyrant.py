@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_asynctyrant.py
+
+Tests of asynctyrant against an in-process fake Tokyo Tyrant that speaks
+the binary protocol for the commands the clients use. Run from this
+directory with
+
+    python -m unittest test_asynctyrant
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import socket
+import struct
+import threading
+import time
+import unittest
+import SocketServer
+
+import asynctyrant
+import pytyrant
+
+
+class _FakeTyrantHandler(SocketServer.BaseRequestHandler):
+    def recv(self, n):
+        data = ""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def string(self):
+        return self.recv(struct.unpack(">I", self.recv(4))[0])
+
+    def handle(self):
+        db = self.server.db
+        try:
+            while True:
+                (magic, code) = struct.unpack(">BB", self.recv(2))
+                if code == pytyrant.C.put:
+                    (klen, vlen) = struct.unpack(">II", self.recv(8))
+                    key = self.recv(klen)
+                    db[key] = self.recv(vlen)
+                    reply = "\0"
+                elif code == pytyrant.C.get:
+                    key = self.string()
+                    if key in db:
+                        reply = "\0" + struct.pack(">I", len(db[key])) + db[key]
+                    else:
+                        reply = "\1"
+                elif code == pytyrant.C.out:
+                    key = self.string()
+                    reply = "\0" if db.pop(key, None) is not None else "\1"
+                elif code == pytyrant.C.fwmkeys:
+                    (plen, maxkeys) = struct.unpack(">II", self.recv(8))
+                    prefix = self.recv(plen)
+                    keys = sorted(k for k in db if k.startswith(prefix))
+                    if maxkeys < 0x80000000:
+                        keys = keys[:maxkeys]
+                    reply = "\0" + struct.pack(">I", len(keys)) + "".join(struct.pack(">I", len(k)) + k for k in keys)
+                elif code == pytyrant.C.rnum:
+                    reply = "\0" + struct.pack(">Q", len(db))
+                elif code == pytyrant.C.stat:
+                    stats = "rnum\t%d\nversion\tfake\n" % len(db)
+                    reply = "\0" + struct.pack(">I", len(stats)) + stats
+                elif code == pytyrant.C.misc:
+                    (flen, opts, nargs) = struct.unpack(">III", self.recv(12))
+                    func = self.recv(flen)
+                    args = [self.string() for i in xrange(nargs)]
+                    values = []
+                    if func == "getlist":
+                        for key in args:
+                            if key in db:
+                                values.extend([key, db[key]])
+                    elif func == "putlist":
+                        for i in xrange(0, len(args), 2):
+                            db[args[i]] = args[i + 1]
+                    elif func == "outlist":
+                        for key in args:
+                            db.pop(key, None)
+                    reply = "\0" + struct.pack(">I", len(values)) + "".join(struct.pack(">I", len(v)) + v for v in values)
+                else:
+                    reply = "\1"
+                if self.server.trickle:
+                    # Send the reply a few bytes at a time
+                    for i in xrange(0, len(reply), 32):
+                        self.request.sendall(reply[i:i + 32])
+                        time.sleep(self.server.trickle)
+                else:
+                    self.request.sendall(reply)
+        except (EOFError, socket.error):
+            pass
+
+
+class FakeTyrant(SocketServer.ThreadingTCPServer):
+    """ A Tyrant server holding its records in a dict, on a free port """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), _FakeTyrantHandler)
+        self.db = {}
+        # Seconds between the 32 byte pieces of each reply, or 0
+        self.trickle = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class AsyncTyrantTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTyrant()
+        self.server.db.update(("k%d" % i, "v%d" % i) for i in xrange(1000))
+        self.tyrant = asynctyrant.AsyncTyrant("127.0.0.1", self.server.port)
+
+    def tearDown(self):
+        self.tyrant.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait(self, futures, timeout=10.0):
+        asynctyrant.wait(futures, map=self.tyrant.map, timeout=timeout)
+        return futures
+
+    def test_get(self):
+        (found, missing) = self.wait([self.tyrant.get("k1"), self.tyrant.get("missing")])
+        self.assertEqual(found.result(), "v1")
+        self.assertTrue(isinstance(missing.exception(), KeyError))
+
+    def test_multi_get(self):
+        big = "y" * 500000
+        self.wait([self.tyrant.multi_set([("big", big)])])
+        (f,) = self.wait([self.tyrant.multi_get(["k2", "nope", "big"])])
+        self.assertEqual(f.result(), ["v2", None, big])
+
+    def test_multi_del(self):
+        (deleted, f) = self.wait([self.tyrant.multi_del(["k1"]), self.tyrant.get("k1")])
+        self.assertTrue(isinstance(f.exception(), KeyError))
+        self.assertFalse("k1" in self.server.db)
+
+    def test_prefix_keys(self):
+        (f, limited) = self.wait([self.tyrant.prefix_keys("k99"), self.tyrant.prefix_keys("k9", 3)])
+        self.assertEqual(f.result(), ["k99"] + ["k99%d" % i for i in xrange(10)])
+        self.assertEqual(len(limited.result()), 3)
+
+    def test_get_stats(self):
+        (f,) = self.wait([self.tyrant.get_stats()])
+        self.assertEqual(f.result()["version"].strip(), "fake")
+
+    def test_many_in_flight(self):
+        futures = self.wait([self.tyrant.get("k%d" % i) for i in xrange(1000)])
+        self.assertEqual([f.result() for f in futures], ["v%d" % i for i in xrange(1000)])
+
+    def test_two_clients_on_one_loop(self):
+        other = asynctyrant.AsyncTyrant("127.0.0.1", self.server.port, map=self.tyrant.map)
+        futures = self.wait([self.tyrant.get("k5"), other.get("k6")])
+        self.assertEqual([f.result() for f in futures], ["v5", "v6"])
+        other.close()
+
+    def test_connection_loss(self):
+        f = self.tyrant.get("k7")
+        self.tyrant.close()
+        self.assertTrue(isinstance(f.exception(), pytyrant.TyrantConnectionError))
+        # The next command reconnects
+        (f,) = self.wait([self.tyrant.get("k7")])
+        self.assertEqual(f.result(), "v7")
+
+    def test_trickled_reply(self):
+        # Many small reads must not use up the timeout early
+        self.server.db["long"] = "z" * 2000
+        self.server.trickle = 0.01
+        started = time.time()
+        (f,) = self.wait([self.tyrant.get("long")], timeout=3.0)
+        self.assertEqual(f.result(), "z" * 2000)
+        self.assertTrue(time.time() - started < 3.0)
+
+    def test_timeout(self):
+        self.server.db["long"] = "z" * 2000
+        self.server.trickle = 0.1
+        started = time.time()
+        self.assertRaises(socket.timeout, self.wait, [self.tyrant.get("long")], 0.5)
+        self.assertTrue(time.time() - started >= 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
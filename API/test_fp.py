@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_fp.py
+
+Tests of the fp matching functions, using the local index so that no Solr
+or Tokyo Tyrant is needed. Run from this directory with
+
+    python -m unittest test_fp
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import unittest
+
+import fp
+
+
+def _code_string(pairs):
+    return " ".join("%d %d" % pair for pair in pairs)
+
+
+class LongSpanTest(unittest.TestCase):
+    """ Queries whose times are billions apart, which a client can send as
+        a plain code string """
+    track = _code_string([(1000 + i, 500 + i) for i in xrange(40)] + [(139, 600)])
+    query = _code_string([(1000 + i, 100 + i) for i in xrange(40)] + [(139, -2000000000)])
+
+    def setUp(self):
+        fp.local_erase_database()
+
+    def tearDown(self):
+        fp.local_erase_database()
+
+    def test_actual_matches(self):
+        self.assertEqual(fp.actual_matches(self.query, self.track), 41)
+
+    def test_int32_extremes(self):
+        query = self.query + " 140 2147483647 141 -2147483648"
+        track = self.track + " 140 700 141 800"
+        self.assertEqual(fp.actual_matches(query, track), 41)
+
+    def test_best_match_for_query(self):
+        fp.ingest([{"track_id": "TRSPAN", "fp": self.track, "length": "300", "codever": "4.12"}], local=True)
+        response = fp.best_match_for_query(self.query, local=True)
+        self.assertEqual(response.TRID, "TRSPAN")
+        self.assertEqual(response.score, 41)
+
+
+class CachedMetadataTest(unittest.TestCase):
+    """ Callers may change the metadata they are given without changing
+        what the caches hand out next """
+    track = _code_string([(1000 + i, 500 + i) for i in xrange(40)])
+    query = _code_string([(1000 + i, 100 + i) for i in xrange(40)])
+
+    def setUp(self):
+        fp.local_erase_database()
+        fp.set_query_cache()
+        fp.ingest([{"track_id": "TRMETA", "fp": self.track, "length": "300", "codever": "4.12", "artist": "a"}], local=True)
+
+    def tearDown(self):
+        fp.set_query_cache(0)
+        fp.local_erase_database()
+
+    def test_metadata_for_track_id(self):
+        fp.metadata_for_track_id("TRMETA", local=True)["title"] = "t"
+        self.assertFalse("title" in fp.metadata_for_track_id("TRMETA", local=True))
+
+    def test_query_cache(self):
+        fp.best_match_for_query(self.query, local=True).metadata["title"] = "t"
+        fp.best_match_for_query(self.query, local=True).metadata["title"] = "t"
+        response = fp.best_match_for_query(self.query, local=True)
+        self.assertEqual(response.TRID, "TRMETA")
+        self.assertEqual(response.metadata, {"artist": "a", "length": "300", "codever": "4.12"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_ingestqueue.py
+
+Tests of the ingest queue, writing to the local index. Run from this
+directory with
+
+    python -m unittest test_ingestqueue
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import logging
+import unittest
+
+import fp
+import ingestqueue
+
+
+def _fingerprint(i, **fields):
+    fprint = {"track_id": "TRQ%d" % i, "length": "300", "codever": "4.12",
+              "fp": " ".join("%d %d" % (i * 100 + j, j) for j in xrange(50))}
+    fprint.update(fields)
+    return fprint
+
+
+class IngestQueueTest(unittest.TestCase):
+    def setUp(self):
+        fp.local_erase_database()
+        logging.disable(logging.CRITICAL)
+        self.queue = ingestqueue.IngestQueue(max_docs=100, max_delay=10.0, local=True)
+
+    def tearDown(self):
+        self.queue.close()
+        logging.disable(logging.NOTSET)
+        fp.local_erase_database()
+
+    def test_committed(self):
+        tickets = [self.queue.submit(_fingerprint(i)) for i in xrange(3)]
+        self.assertEqual(self.queue.flush(5.0)["status"], ingestqueue.COMMITTED)
+        self.assertEqual([self.queue.status(t)["status"] for t in tickets], [ingestqueue.COMMITTED] * 3)
+        self.assertEqual(sorted(fp._local_index.track_ids()), ["TRQ0-0", "TRQ1-0", "TRQ2-0"])
+
+    def test_refused(self):
+        for fields in ({"fp": "1 2 x"}, {"length": "abc"}, {"length": "3.5"},
+                       {"codever": 4.12}, {"import_date": "yesterday"}):
+            self.assertRaises(ValueError, self.queue.submit, _fingerprint(0, **fields))
+        self.assertEqual(self.queue.stats()["last_ticket"], 0)
+
+    def test_one_bad_fingerprint(self):
+        # Passes the checks, but the local index only takes 20 bit hashes
+        tickets = [self.queue.submit(_fingerprint(i)) for i in xrange(5)]
+        bad = self.queue.submit(_fingerprint(5, fp="4000000000 1"))
+        tickets += [self.queue.submit(_fingerprint(i)) for i in xrange(6, 9)]
+        self.queue.flush(5.0)
+        self.assertEqual([self.queue.status(t)["status"] for t in tickets], [ingestqueue.COMMITTED] * 8)
+        self.assertEqual(self.queue.status(bad)["status"], ingestqueue.FAILED)
+        self.assertTrue("4000000000" in self.queue.status(bad)["error"])
+        self.assertEqual(len(list(fp._local_index.track_ids())), 8)
+        self.assertEqual(self.queue.stats()["flushed"], 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
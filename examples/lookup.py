@@ -31,7 +31,7 @@ def codegen(file, start=0, duration=30):
 def lookup(file):
     codes = codegen(file)
     if len(codes) and "code" in codes[0]:
-        decoded = fp.decode_code_string(codes[0]["code"])
+        decoded = fp.decode_codes(codes[0]["code"])
         result = fp.best_match_for_query(decoded)
         print "Got result:", result
         if result.TRID:
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+# Copyright The Echo Nest 2011
+
+# The dump loop shared by master_dump and slave_dump.
+# Documents are read from solr in track_id order, each page starting where the last
+# one ended (a range query on track_id rather than a growing start offset). Every page
+# costs about the same however deep the dump is, and documents ingested while it runs
+# can't shift the pages under it.
+# The codes of a page are fetched from tokyo tyrant with a few multi_gets, and reading
+# solr, reading tyrant and writing the files run at the same time: while one page is
+# written, the codes of the next are fetched and the page after that is read from solr.
+# After each page a checkpoint is written, so a dump that stops can be run again to
+# carry on where it left off. The checkpoint is removed when the dump completes.
+
+import sys
+import os
+import datetime
+import csv
+import threading
+import Queue
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, "../API")
+import fp
+import solr
+import replfile
+
+ITEMS_PER_FILE=250000
+PAGE_ROWS=10000
+# Keys per tyrant multi_get
+CODES_PER_GET=1000
+# Pages each stage reads ahead of the next
+READ_AHEAD=2
+
+def iter_pages(host, query, after=None, rows=PAGE_ROWS):
+    """ Pages (lists of documents) matching query, in track_id order,
+        starting after the track id after """
+    while True:
+        q = "*:*"
+        if after is not None:
+            # Solr ranges are inclusive at both ends or neither, so ask for
+            # one more row and drop the track we ended on last time
+            q = 'track_id:["%s" TO *]' % after.replace("\\", "\\\\").replace('"', '\\"')
+            rows_wanted = rows + 1
+        else:
+            rows_wanted = rows
+        response = host.query(q, fq=query, sort="track_id asc", rows=rows_wanted, score=False)
+        page = [r for r in response.results if r["track_id"] != after]
+        if not page:
+            return
+        yield page
+        after = page[-1]["track_id"]
+
+def fetch_codes(tyrant, page):
+    """ The codes of each document in page """
+    codes = []
+    for i in xrange(0, len(page), CODES_PER_GET):
+        keys = [str(r["track_id"]) for r in page[i:i+CODES_PER_GET]]
+        for (key, code) in zip(keys, tyrant.multi_get(keys)):
+            if code is None:
+                raise KeyError(key)
+            codes.append(code)
+    return codes
+
+def read_ahead(iterable, depth=READ_AHEAD):
+    """ Yield the items of iterable, taking them from it in a thread of its
+        own that stays up to depth items ahead """
+    queue = Queue.Queue(depth)
+    def run():
+        try:
+            for item in iterable:
+                queue.put((True, item))
+        except Exception, e:
+            queue.put((False, e))
+            return
+        queue.put((False, None))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    while True:
+        (ok, item) = queue.get()
+        if not ok:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+def row(r, codes):
+    return [r["track_id"],
+            r["codever"],
+            codes,
+            r["length"],
+            r.get("artist", ""),
+            r.get("release", ""),
+            r.get("track", "")
+           ]
+
+def open_writer(out, binary):
+    if binary:
+        return replfile.Writer(out)
+    return csv.writer(out)
+
+def dump(tyrant, query, make_filename, checkpoint, binary=True):
+    """ Dump the documents matching query % (date of the last dump, now) to
+        files named make_filename(now, file number) plus the extension of
+        their format, binary (see replfile.py) or CSV, then store now as the
+        date of the last dump. If the checkpoint file exists, carry on the
+        dump it was written by. """
+    if binary:
+        extension = replfile.EXTENSION
+    else:
+        extension = ".csv"
+    if os.path.exists(checkpoint):
+        state = json.load(open(checkpoint))
+        print "resuming the dump of %s after %s (%d entries written)" % (state["now"], state["after"], state["dumped"])
+    else:
+        try:
+            lastdump = tyrant["lastdump"]
+        except KeyError:
+            lastdump = "*"
+        state = {"now": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 "lastdump": lastdump,
+                 "after": None,
+                 "filecount": 1,
+                 "itemcount": 0,
+                 "offset": 0,
+                 "dumped": 0}
+
+    out = open(make_filename(state["now"], state["filecount"]) + extension, "a+b")
+    # Drop anything written after the last checkpoint
+    out.truncate(state["offset"])
+    writer = open_writer(out, binary)
+    with solr.pooled_connection(fp._fp_solr) as host:
+        pages = read_ahead(iter_pages(host, query % (state["lastdump"], state["now"]), state["after"]))
+        for (page, codes) in read_ahead((page, fetch_codes(tyrant, page)) for page in pages):
+            for (r, code) in zip(page, codes):
+                writer.writerow(row(r, code))
+            if binary:
+                writer.flush()
+            state["after"] = page[-1]["track_id"]
+            state["itemcount"] += len(page)
+            state["dumped"] += len(page)
+            print "wrote %d results up to %s" % (state["dumped"], state["after"])
+            if state["itemcount"] >= ITEMS_PER_FILE:
+                if binary:
+                    writer.finish()
+                out.close()
+                state["filecount"] += 1
+                state["itemcount"] = 0
+                filename = make_filename(state["now"], state["filecount"]) + extension
+                print "Making new file, %s" % filename
+                out = open(filename, "w+b")
+                writer = open_writer(out, binary)
+            out.flush()
+            os.fsync(out.fileno())
+            state["offset"] = out.tell()
+            _save_checkpoint(checkpoint, state)
+    if binary:
+        writer.finish()
+    out.close()
+
+    # Write the final completion time
+    tyrant["lastdump"] = state["now"]
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+def _save_checkpoint(checkpoint, state):
+    tmpname = checkpoint + ".tmp"
+    f = open(tmpname, "w")
+    json.dump(state, f)
+    f.close()
+    os.rename(tmpname, checkpoint)
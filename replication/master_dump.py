@@ -6,65 +6,27 @@
 # We store the date of the last dump in the tokyo tyrant database under the key 'lastdump'
 # If the key doesn't exist, we assume there has been no dump on this database, and dump everything.
 # Files generated from this script can be ingested with the import_replication.py script
+# If a dump is interrupted, running the script again carries it on (see dumper.py)
 
 import sys
 import os
 sys.path.insert(0, "../API")
 import fp
 import pytyrant
-import solr
-import datetime
-import csv
+import dumper
 
 tyrant = pytyrant.PyTyrant.open("localhost", 1978)
-now = datetime.datetime.utcnow()
-now = now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-ITEMS_PER_FILE=250000
-FILENAME_TEMPLATE="echoprint-replication-out-%s-%d.csv"
+FILENAME_TEMPLATE="echoprint-replication-out-%s-%d"
+CHECKPOINT="echoprint-replication-out.checkpoint"
 
-def dump(start=0):
-    try:
-        lastdump = tyrant["lastdump"]
-    except KeyError:
-        lastdump = "*"
-
-    filecount = 1
-    itemcount = 1
-    filename = FILENAME_TEMPLATE % (now, filecount)
-    writer = csv.writer(open(filename, "w"))
-    with solr.pooled_connection(fp._fp_solr) as host:
-        items_to_dump = host.query("import_date:[%s TO %s]" % (lastdump, now), rows=10000, start=start)
-        print "going to dump %s entries" % items_to_dump.results.numFound
-        resultlen = len(items_to_dump)
-        while resultlen > 0:
-            print "writing %d results from start=%s" % (resultlen, items_to_dump.results.start)
-            for r in items_to_dump.results:
-                row = [r["track_id"],
-                       r["codever"],
-                       tyrant[str(r["track_id"])],
-                       r["length"],
-                       r.get("artist", ""),
-                       r.get("release", ""),
-                       r.get("track", "")
-                      ]
-                writer.writerow(row)
-            itemcount += resultlen
-            if itemcount > ITEMS_PER_FILE:
-                filecount += 1
-                filename = FILENAME_TEMPLATE % (now, filecount)
-                print "Making new file, %s" % filename
-                writer = csv.writer(open(filename, "w"))
-                itemcount = resultlen
-            items_to_dump = items_to_dump.next_batch()
-            resultlen = len(items_to_dump)
-
-    # Write the final completion time
-    tyrant["lastdump"] = now
+def dump(binary=True):
+    dumper.dump(tyrant, "import_date:[%s TO %s]",
+                lambda now, filecount: FILENAME_TEMPLATE % (now, filecount), CHECKPOINT, binary)
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        start = int(sys.argv[1])
+    if len(sys.argv) > 1 and sys.argv[1] == "-c":
+        # CSV, for servers whose ingest scripts can't read the binary format
+        dump(binary=False)
     else:
-        start = 0
-    dump(start)
\ No newline at end of file
+        dump()
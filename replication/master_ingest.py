@@ -9,19 +9,17 @@
 
 import sys
 import datetime
-import csv
 
 sys.path.insert(0, "../API")
 import fp
+import replfile
 
 now = datetime.datetime.utcnow()
 now = now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 def ingest(source, file):
-    if file == "-":
-        reader = csv.reader(sys.stdin)
-    else:
-        reader = csv.reader(open(file))
+    # Binary or CSV, see replfile.py
+    reader = replfile.rows(file)
     ingest_list = []
     size = 0
     for line in reader:
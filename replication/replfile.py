@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+# Copyright The Echo Nest 2011
+
+# The binary replication file format, written by master_dump and slave_dump and read by
+# master_ingest and slave_ingest alongside CSV. It holds the same rows as the CSV files,
+# with the codes stored as integers rather than text and each block of rows compressed.
+#
+# A file is MAGIC, then blocks of up to BLOCK_RECORDS rows, then an index:
+#   block:   ">III" row count, payload length, CRC-32 of the payload,
+#            ">H" the length of the track id of the block's first row, and the id,
+#            then the zlib-compressed payload
+#   payload: one column after another, for all rows of the block:
+#            track_id, codever, artist, release, track: varint lengths, then the strings
+#            length: varints
+#            number of codes in each row: varints
+#            times: zigzag varints of the difference from the time before
+#            hash codes: varints
+#   index:   a block with a row count of 0, whose payload is the JSON list
+#            [[first track id, offset, row count], ...] of the blocks,
+#            then ">Q" the offset of the index block and MAGIC again
+# Rows are read block by block, so a file can be streamed from stdin. Dumps are written
+# in track_id order, so seek() can use the index to start reading at any track id.
+
+import sys
+import struct
+import zlib
+import bisect
+import csv
+import itertools
+from cStringIO import StringIO
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import numpy
+
+sys.path.insert(0, "../API")
+import fp
+
+MAGIC = "EPRF\x01"
+EXTENSION = ".epr"
+BLOCK_RECORDS = 1000
+
+_BLOCK_HEADER = struct.Struct(">III")
+_ID_LENGTH = struct.Struct(">H")
+_TRAILER = struct.Struct(">Q")
+
+def _encode_varints(values):
+    """ The varint encoding of an array of non-negative integers """
+    values = numpy.asarray(values, dtype=numpy.int64)
+    if not len(values):
+        return ""
+    groups = [values & 0x7f]
+    nbytes = numpy.ones(len(values), dtype=numpy.int64)
+    rest = values >> 7
+    while rest.any():
+        nbytes += rest > 0
+        groups.append(rest & 0x7f)
+        rest >>= 7
+    groups = numpy.array(groups, dtype=numpy.uint8).T
+    place = numpy.arange(groups.shape[1])
+    # Every byte but the last of a value has the high bit set
+    groups |= (place < (nbytes - 1)[:, None]).astype(numpy.uint8) << 7
+    return groups[place < nbytes[:, None]].tostring()
+
+def _decode_varints(buf, pos, count):
+    """ (count integers decoded from buf at pos, the position after them) """
+    if count == 0:
+        return (numpy.zeros(0, dtype=numpy.int64), pos)
+    data = numpy.frombuffer(buf, dtype=numpy.uint8, count=min(len(buf) - pos, 10 * count), offset=pos)
+    ends = numpy.flatnonzero(data < 0x80)[:count]
+    if len(ends) < count:
+        raise ValueError("the block ends early")
+    starts = numpy.empty(count, dtype=numpy.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    data = data[:ends[-1] + 1].astype(numpy.int64)
+    place = numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)
+    values = numpy.add.reduceat((data & 0x7f) << (7 * place), starts)
+    return (values, pos + ends[-1] + 1)
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+def _unzigzag(values):
+    return (values >> 1) ^ -(values & 1)
+
+def _text(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return str(s)
+
+def _encode_block(rows):
+    (track_ids, codevers, codes, lengths, artists, releases, tracks) = zip(*rows)
+    parts = []
+    for strings in (track_ids, codevers, artists, releases, tracks):
+        strings = [_text(s) for s in strings]
+        parts.append(_encode_varints([len(s) for s in strings]))
+        parts.append("".join(strings))
+    parts.append(_encode_varints([int(length) for length in lengths]))
+    parts.append(_encode_varints([len(c) for c in codes]))
+    times = numpy.concatenate([c.times for c in codes]).astype(numpy.int64)
+    parts.append(_encode_varints(_zigzag(numpy.concatenate((times[:1], numpy.diff(times))))))
+    parts.append(_encode_varints(numpy.concatenate([c.codes for c in codes])))
+    return "".join(parts)
+
+def _decode_block(payload, count):
+    pos = 0
+    columns = []
+    for i in xrange(5):
+        (lengths, pos) = _decode_varints(payload, pos, count)
+        strings = []
+        for length in lengths.tolist():
+            strings.append(payload[pos:pos + length])
+            pos += length
+        columns.append(strings)
+    (lengths, pos) = _decode_varints(payload, pos, count)
+    (ncodes, pos) = _decode_varints(payload, pos, count)
+    total = int(ncodes.sum())
+    (times, pos) = _decode_varints(payload, pos, total)
+    times = numpy.cumsum(_unzigzag(times))
+    (hashes, pos) = _decode_varints(payload, pos, total)
+    bounds = numpy.concatenate(([0], numpy.cumsum(ncodes))).tolist()
+    codes = [fp.Codes(hashes[bounds[i]:bounds[i + 1]], times[bounds[i]:bounds[i + 1]]) for i in xrange(count)]
+    (track_ids, codevers, artists, releases, tracks) = columns
+    return zip(track_ids, codevers, codes, lengths.tolist(), artists, releases, tracks)
+
+def _read_block(f):
+    """ (first track id, row count, payload) of the block at the position of
+        f, or None at the end of the file """
+    header = f.read(_BLOCK_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _BLOCK_HEADER.size:
+        raise ValueError("the file ends in the middle of a block")
+    (count, size, crc) = _BLOCK_HEADER.unpack(header)
+    (idlength,) = _ID_LENGTH.unpack(f.read(_ID_LENGTH.size))
+    first = f.read(idlength)
+    payload = f.read(size)
+    if len(payload) < size:
+        raise ValueError("the file ends in the middle of a block")
+    if zlib.crc32(payload) & 0xffffffff != crc:
+        raise ValueError("block of %s has a bad checksum" % first)
+    return (first, count, payload)
+
+def _write_block(f, first, count, payload):
+    payload = zlib.compress(payload)
+    first = _text(first)
+    f.write(_BLOCK_HEADER.pack(count, len(payload), zlib.crc32(payload) & 0xffffffff))
+    f.write(_ID_LENGTH.pack(len(first)))
+    f.write(first)
+    f.write(payload)
+
+class Writer(object):
+    """ Writes rows to a replication file. Rows are written out a block at a
+        time; finish() writes any that are left and the index. """
+    def __init__(self, f):
+        """ Write to file f, open for reading and appending. If it already
+            holds blocks (a dump being carried on), more are added after them. """
+        self.f = f
+        self.index = []
+        self._rows = []
+        f.seek(0, 2)
+        if f.tell() == 0:
+            f.write(MAGIC)
+            return
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a replication file")
+        while True:
+            offset = f.tell()
+            header = f.read(_BLOCK_HEADER.size)
+            if not header:
+                break
+            (count, size, crc) = _BLOCK_HEADER.unpack(header)
+            (idlength,) = _ID_LENGTH.unpack(f.read(_ID_LENGTH.size))
+            self.index.append([f.read(idlength).decode("utf-8"), offset, count])
+            f.seek(size, 1)
+        f.seek(0, 2)
+
+    def writerow(self, row):
+        """ Write a row in the order of the CSV files: track_id, codever,
+            codes (a code string or fp.Codes), length, artist, release, track """
+        row = list(row)
+        if not isinstance(row[2], fp.Codes):
+            row[2] = fp.Codes.from_string(row[2])
+        self._rows.append(row)
+        if len(self._rows) >= BLOCK_RECORDS:
+            self.flush()
+
+    def flush(self):
+        """ Write out the rows held so far as a block """
+        if not self._rows:
+            return
+        offset = self.f.tell()
+        first = self._rows[0][0]
+        _write_block(self.f, first, len(self._rows), _encode_block(self._rows))
+        self.index.append([_text(first).decode("utf-8"), offset, len(self._rows)])
+        self._rows = []
+
+    def finish(self):
+        self.flush()
+        offset = self.f.tell()
+        _write_block(self.f, "", 0, json.dumps(self.index))
+        self.f.write(_TRAILER.pack(offset))
+        self.f.write(MAGIC)
+
+class Reader(object):
+    """ The rows of a replication file, with the codes as fp.Codes and
+        the length as an integer """
+    def __init__(self, f, magic_read=False):
+        """ Read file f. magic_read says its MAGIC has already been read. """
+        self.f = f
+        self.after = None
+        if not magic_read and f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a replication file")
+
+    def index(self):
+        """ The [first track id, offset, row count] of each block """
+        self.f.seek(-(_TRAILER.size + len(MAGIC)), 2)
+        (offset,) = _TRAILER.unpack(self.f.read(_TRAILER.size))
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("the file has no index")
+        self.f.seek(offset)
+        (first, count, payload) = _read_block(self.f)
+        return json.loads(zlib.decompress(payload))
+
+    def seek(self, track_id):
+        """ Start reading at the first row with a track_id of at least track_id """
+        index = self.index()
+        track_id = _text(track_id)
+        i = bisect.bisect_right([first.encode("utf-8") for (first, offset, count) in index], track_id) - 1
+        self.f.seek(index[max(i, 0)][1] if index else len(MAGIC))
+        self.after = track_id
+
+    def __iter__(self):
+        while True:
+            block = _read_block(self.f)
+            if block is None:
+                raise ValueError("the file ends before its index")
+            (first, count, payload) = block
+            if count == 0:
+                return
+            for row in _decode_block(zlib.decompress(payload), count):
+                if self.after is None or row[0] >= self.after:
+                    yield row
+
+def rows(file):
+    """ The rows of a replication file, binary or CSV, named file or "-" for stdin """
+    if file == "-":
+        f = sys.stdin
+    else:
+        f = open(file, "rb")
+    start = f.read(len(MAGIC))
+    if start == MAGIC:
+        return Reader(f, magic_read=True)
+    return csv.reader(itertools.chain(StringIO(start + f.readline()), f))
@@ -14,17 +14,14 @@ sys.path.insert(0, "../API")
 import fp
 import pytyrant
 import solr
-import datetime
-import csv
+import dumper
 
 SLAVE_NAME="thisslave"
 
 tyrant = pytyrant.PyTyrant.open("localhost", 1978)
-now = datetime.datetime.utcnow()
-now = now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-ITEMS_PER_FILE=250000
-FILENAME_TEMPLATE="echoprint-slave-%s-%s-%d.csv"
+FILENAME_TEMPLATE="echoprint-slave-%s-%s-%d"
+CHECKPOINT="echoprint-slave.checkpoint"
 
 def check_for_fields():
     with solr.pooled_connection(fp._fp_solr) as host:
@@ -37,46 +34,14 @@ def check_for_fields():
             print >>sys.stderr, "Missing 'import_date' field on at least one doc. Run util/upgrade_server.py"
             sys.exit(1)        
 
-def dump(start=0):
+def dump(binary=True):
     check_for_fields()
-    try:
-        lastdump = tyrant["lastdump"]
-    except KeyError:
-        lastdump = "*"
-    filecount = 1
-    itemcount = 1
-    filename = FILENAME_TEMPLATE % (SLAVE_NAME, now, filecount)
-    writer = csv.writer(open(filename, "w"))
-    with solr.pooled_connection(fp._fp_solr) as host:
-        items_to_dump = host.query("source:local AND import_date:[%s TO %s]" % (lastdump, now), rows=10000, start=start)
-        resultlen = len(items_to_dump)
-        while resultlen > 0:
-            print "writing %d results from start=%s" % (resultlen, items_to_dump.results.start)
-            for r in items_to_dump.results:
-                row = [r["track_id"],
-                       r["codever"],
-                       tyrant[str(r["track_id"])],
-                       r["length"],
-                       r.get("artist", ""),
-                       r.get("release", ""),
-                       r.get("track", "")
-                      ]
-                writer.writerow(row)
-            itemcount += resultlen
-            if itemcount > ITEMS_PER_FILE:
-                filecount += 1
-                filename = FILENAME_TEMPLATE % (SLAVE_NAME, now, filecount)
-                print "Making new file, %s" % filename
-                writer = csv.writer(open(filename, "w"))
-                itemcount = resultlen
-            items_to_dump = items_to_dump.next_batch()
-            resultlen = len(items_to_dump)
-    # Write the final completion time
-    tyrant["lastdump"] = now
+    dumper.dump(tyrant, "source:local AND import_date:[%s TO %s]",
+                lambda now, filecount: FILENAME_TEMPLATE % (SLAVE_NAME, now, filecount), CHECKPOINT, binary)
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        start = int(sys.argv[1])
+    if len(sys.argv) > 1 and sys.argv[1] == "-c":
+        # CSV, for servers whose ingest scripts can't read the binary format
+        dump(binary=False)
     else:
-        start = 0
-    dump(start)
\ No newline at end of file
+        dump()
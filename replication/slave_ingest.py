@@ -5,20 +5,18 @@
 # Ingest a dump from a master server.
 
 import sys
-import csv
 import datetime
 
 sys.path.insert(0, "../API")
 import fp
+import replfile
 
 now = datetime.datetime.utcnow()
 now = now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 def ingest(file):
-    if file == "-":
-        reader = csv.reader(sys.stdin)
-    else:
-        reader = csv.reader(open(file))
+    # Binary or CSV, see replfile.py
+    reader = replfile.rows(file)
     ingest_list = []
     size = 0
     for line in reader:
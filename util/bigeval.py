@@ -23,6 +23,7 @@ import random
 import math
 sys.path.insert(0, "../API")
 import fp
+import bigevalfile
 
 config.CODEGEN_BINARY_OVERRIDE = os.path.abspath("../../echoprint-codegen/echoprint-codegen")
 
@@ -367,7 +368,7 @@ def usage():
     print "\t-m\t--mono    \tMono decoder. (off)"
     print "\t-2\t--22kHz   \tDownsample to 22kHz (off)"
     print "\t-B\t--binary  \tPath to the binary to use for this test (codegen on path)"
-    print "\t-t\t--test    \tlist of files to check. pickle of {trid:path, trid2:path2}, or 'none'"
+    print "\t-t\t--test    \tlist of files to check, as written by fastingest -b ({trid: metadata with a filename}), or 'none'"
     print "\t-n\t--new     \tnewline separated file of files not in the database, or 'none'"
     print "\t-h\t--help    \tThis help message."
     
@@ -389,7 +390,9 @@ def main(argv):
     channels = 2
     downsample = False
     decoder = "mpg123"
-    testfile = os.path.join(os.path.dirname(__file__), 'bigeval.json')
+    testfile = os.path.join(os.path.dirname(__file__), bigevalfile.FILENAME)
+    if not os.path.exists(testfile):
+        testfile = os.path.join(os.path.dirname(__file__), bigevalfile.LEGACY_FILENAME)
     newfile = "new_music"
     no_shuffle = False
     
@@ -456,9 +459,9 @@ def main(argv):
         _local_bigeval = {}
     else:
         if not os.path.exists(testfile):
-            print >>sys.stderr, "Cannot find bigeval.json. did you run fastingest with the -b flag?"
+            print >>sys.stderr, "Cannot find %s. did you run fastingest with the -b flag?" % bigevalfile.FILENAME
             sys.exit(1)
-        _local_bigeval = json.load(open(testfile,'r'))
+        _local_bigeval = bigevalfile.load(testfile)
     if newfile.lower() == "none" or not os.path.exists(newfile):
         _new_music_files = []
     else:
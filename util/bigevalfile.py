@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bigevalfile.py
+
+The track metadata fastingest -b records for bigeval, as line-delimited
+JSON: one ["track id", {metadata}] record per line. fastingest appends
+records as it ingests, so the file never has to be rewritten; a track
+written again replaces its earlier record. bigeval reads it lazily,
+holding only where each track's record is in memory.
+
+Copyright (c) The Echo Nest Corporation. All rights reserved.
+"""
+import UserDict
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+FILENAME = "bigeval.jsonl"
+# Written by older versions of fastingest: one JSON object of all tracks
+LEGACY_FILENAME = "bigeval.json"
+
+
+def write(f, bigeval):
+    """ Append the records of a {track id: metadata} dict to file f """
+    f.write("".join(json.dumps([trid, m]) + "\n" for (trid, m) in bigeval.iteritems()))
+    f.flush()
+
+
+def load(filename):
+    """ The {track id: metadata} of a bigeval file, lazily for line-delimited
+        ones and read whole for the legacy format """
+    f = open(filename, "rb")
+    first = f.read(1)
+    f.seek(0)
+    if first == "{":
+        return json.load(f)
+    return BigEvalFile(f)
+
+
+class BigEvalFile(UserDict.DictMixin):
+    """ A read-only dict of the records in a line-delimited bigeval file """
+    def __init__(self, f):
+        self._file = f
+        self._offsets = {}
+        decoder = json.JSONDecoder()
+        offset = 0
+        for line in f:
+            if line.strip():
+                # Only the track id at the start of the record is decoded here
+                (trid, end) = decoder.raw_decode(line, 1)
+                self._offsets[trid] = offset
+            offset += len(line)
+
+    def __getitem__(self, trid):
+        self._file.seek(self._offsets[trid])
+        return json.loads(self._file.readline())[1]
+
+    def __contains__(self, trid):
+        return trid in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def keys(self):
+        return self._offsets.keys()
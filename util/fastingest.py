@@ -2,6 +2,11 @@
 
 import sys
 import os
+import re
+import threading
+import multiprocessing
+import Queue
+from collections import deque
 try:
     import json
 except ImportError:
@@ -9,6 +14,43 @@ except ImportError:
 
 sys.path.insert(0, "../API")
 import fp
+import bigevalfile
+
+# Dump records per task for the worker processes in pipelined mode
+CHUNK_RECORDS = 100
+# Batches each writer stage holds before parsing has to wait for it
+WRITE_QUEUE = 4
+
+def dump_record(c):
+    """ The fp.ingest fingerprint and the metadata of a codegen dump record,
+        or None if it has no code to ingest """
+    if "code" not in c:
+        return None
+    code = c["code"]
+    m = c["metadata"]
+    if "track_id" in m:
+        trid = m["track_id"].encode("utf-8")
+    else:
+        trid = fp.new_track_id()
+    length = m["duration"]
+    version = m["version"]
+    artist = m.get("artist", None)
+    title = m.get("title", None)
+    release = m.get("release", None)
+    decoded = fp.decode_codes(code)
+    if decoded is None:
+        print >>sys.stderr, "skipping %s, its code can't be decoded" % trid
+        return None
+
+    data = {"track_id": trid,
+        "fp": decoded,
+        "length": length,
+        "codever": "%.2f" % version
+    }
+    if artist: data["artist"] = artist
+    if release: data["release"] = release
+    if title: data["track"] = title
+    return (data, m)
 
 def parse_json_dump(jfile):
     codes = json.load(open(jfile))
@@ -16,57 +58,201 @@ def parse_json_dump(jfile):
     bigeval = {}
     fullcodes = []
     for c in codes:
-        if "code" not in c:
+        record = dump_record(c)
+        if record is None:
             continue
-        code = c["code"]
-        m = c["metadata"]
-        if "track_id" in m:
-            trid = m["track_id"].encode("utf-8")
-        else:
-            trid = fp.new_track_id()
-        length = m["duration"]
-        version = m["version"]
-        artist = m.get("artist", None)
-        title = m.get("title", None)
-        release = m.get("release", None)
-        decoded = fp.decode_code_string(code)
-        
-        bigeval[trid] = m
-        
-        data = {"track_id": trid,
-            "fp": decoded,
-            "length": length,
-            "codever": "%.2f" % version
-        }
-        if artist: data["artist"] = artist
-        if release: data["release"] = release
-        if title: data["track"] = title
+        (data, m) = record
+        bigeval[data["track_id"]] = m
         fullcodes.append(data)
 
     return (fullcodes, bigeval)
 
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iter_json_array(f, chunk_size=1 << 20):
+    """ Yield the elements of the JSON array in file f one by one, holding
+        only about one chunk_size of it in memory at a time """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    pos = _WHITESPACE.match(buf).end()
+    while pos == len(buf):
+        buf = f.read(chunk_size)
+        if not buf:
+            break
+        pos = _WHITESPACE.match(buf).end()
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("%s doesn't hold a JSON array" % getattr(f, "name", "the file"))
+    pos += 1
+    # What can come next: the first element or "]", an element, or "," or "]"
+    (FIRST, ELEMENT, SEPARATOR) = range(3)
+    expect = FIRST
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError("the JSON array ends early")
+            (buf, pos) = (buf[pos:] + chunk, 0)
+            continue
+        if buf[pos] == "]" and expect != ELEMENT:
+            return
+        if expect == SEPARATOR:
+            if buf[pos] != ",":
+                raise ValueError("expected , or ] at %r" % buf[pos:pos + 20])
+            (pos, expect) = (pos + 1, ELEMENT)
+            continue
+        try:
+            (value, end) = decoder.raw_decode(buf, pos)
+            # Only an element followed by , or ] is whole: a number, say,
+            # could go on in the next chunk
+            after = _WHITESPACE.match(buf, end).end()
+            if buf[after:after + 1] not in (",", "]"):
+                raise ValueError("expected , or ] at %r" % buf[after:after + 20])
+        except ValueError:
+            # Most likely the element doesn't fit in what has been read yet
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            (buf, pos) = (buf[pos:] + chunk, 0)
+            continue
+        yield value
+        (pos, expect) = (end, SEPARATOR)
+        if pos > chunk_size:
+            (buf, pos) = (buf[pos:], 0)
+
+def _prepare_chunk(records):
+    """ Decode and split dump records, in a worker process. Returns the Solr
+        docs and keystore items to write, with their codes already in text
+        form, and the bigeval metadata. """
+    fullcodes = []
+    bigeval = {}
+    for c in records:
+        record = dump_record(c)
+        if record is None:
+            continue
+        (data, m) = record
+        bigeval[data["track_id"]] = m
+        fullcodes.append(data)
+    (docs, codes) = fp.prepare_ingest(fullcodes)
+    docs = [dict(d, fp=str(d["fp"])) for d in docs]
+    codes = [(d["track_id"].encode("utf-8"), d["fp"]) for d in docs]
+    return (docs, codes, bigeval)
+
+class _Writer(threading.Thread):
+    """ A stage writing batches with write() in the background. put() blocks
+        while WRITE_QUEUE batches are waiting. """
+    def __init__(self, write):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.write = write
+        self.error = None
+        self.queue = Queue.Queue(WRITE_QUEUE)
+        self.start()
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            # After an error keep taking batches, so put() can't block forever
+            if self.error is None:
+                try:
+                    self.write(batch)
+                except Exception, e:
+                    self.error = e
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(batch)
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def pipelined_ingest(jfile, pool, window, bigeval=None):
+    """ Ingest a dump without reading it all in. It is parsed as a stream,
+        decoded and split by the processes of pool, and written to Solr and
+        the keystore by one thread each, all at the same time. At most
+        window chunks are with the pool at once. Doesn't commit. Returns
+        the number of tracks ingested, and appends their metadata to the
+        bigeval file if one is given. """
+    docs_writer = _Writer(fp.write_ingest_docs)
+    codes_writer = _Writer(fp.write_ingest_codes)
+    pending = deque()
+    ingested = 0
+    def write(result):
+        (docs, codes, chunk_bigeval) = result
+        docs_writer.put(docs)
+        codes_writer.put(codes)
+        if bigeval is not None:
+            bigevalfile.write(bigeval, chunk_bigeval)
+        return len(chunk_bigeval)
+    try:
+        with open(jfile) as f:
+            for chunk in _chunks(iter_json_array(f), CHUNK_RECORDS):
+                pending.append(pool.apply_async(_prepare_chunk, (chunk,)))
+                if len(pending) >= window:
+                    ingested += write(pending.popleft().get())
+        while pending:
+            ingested += write(pending.popleft().get())
+    finally:
+        docs_writer.finish()
+        codes_writer.finish()
+    return ingested
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print >>sys.stderr, "Usage: %s [-b] [json dump] ..." % sys.argv[0]
-        print >>sys.stderr, "       -b: write a file to disk for bigeval"
+        print >>sys.stderr, "Usage: %s [-b] [-p [-j processes]] [json dump] ..." % sys.argv[0]
+        print >>sys.stderr, "       -b: add the tracks to %s, for bigeval" % bigevalfile.FILENAME
+        print >>sys.stderr, "       -p: pipelined: stream each dump through a pool of processes (one per core, or -j)"
         sys.exit(1)
-    
+
     write_bigeval = False
+    pipelined = False
+    processes = None
     pos = 1
-    if sys.argv[1] == "-b":
-        write_bigeval = True
-        pos = 2
-    
+    while pos < len(sys.argv) and sys.argv[pos].startswith("-"):
+        if sys.argv[pos] == "-b":
+            write_bigeval = True
+        elif sys.argv[pos] == "-p":
+            pipelined = True
+        elif sys.argv[pos] == "-j":
+            pos += 1
+            processes = int(sys.argv[pos])
+        pos += 1
+
+    bigeval_file = None
+    if write_bigeval:
+        bigeval_file = open(bigevalfile.FILENAME, "a")
+    pool = None
+    if pipelined:
+        # Fork the workers before the writer threads start
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
     for (i, f) in enumerate(sys.argv[pos:]):
         print "%d/%d %s" % (i+1, len(sys.argv)-pos, f)
-        codes, bigeval = parse_json_dump(f)
-        fp.ingest(codes, do_commit=False)
-        if write_bigeval:
-            bename = "bigeval.json"
-            if not os.path.exists(bename):
-                be = {}
-            else:
-                be = json.load(open(bename))
-            be.update(bigeval)
-            json.dump(be, open(bename, "w"))
+        if pipelined:
+            count = pipelined_ingest(f, pool, 2 * processes, bigeval_file)
+            print "  %d tracks" % count
+        else:
+            codes, bigeval = parse_json_dump(f)
+            fp.ingest(codes, do_commit=False)
+            if bigeval_file is not None:
+                bigevalfile.write(bigeval_file, bigeval)
+    if pool is not None:
+        pool.close()
+        pool.join()
     fp.commit()
@@ -61,8 +61,9 @@ def munge(file):
 def get_winners(query_code_string, response, elbow=8):
     actual = {}
     original = {}
-    for x in response.results:
-        actual[x["track_id"]] = fp.actual_matches(query_code_string, x["fp"], elbow=elbow)
+    scores = fp.actual_matches_batch(query_code_string, [x["fp"] for x in response.results], elbow=elbow)
+    for (x, score) in zip(response.results, scores):
+        actual[x["track_id"]] = score
         original[x["track_id"]] = int(x["score"])
 
     sorted_actual_scores = sorted(actual.iteritems(), key=lambda (k,v): (v,k), reverse=True)
@@ -85,7 +86,7 @@ def main():
     fp_codes = []
     limit = int(sys.argv[3])
     if sys.argv[1] == "disk":
-        fp.local_load("disk.pkl")
+        fp.local_load("disk.idx")
     else:
         database_list = open(sys.argv[1]).read().split("\n")[0:limit]
         for line in database_list:
@@ -94,7 +95,7 @@ def main():
             # TODO - use threaded codegen
             j = codegen(file, start=-1, duration=-1)
             if len(j):
-                code_str = fp.decode_code_string(j[0]["code"])
+                code_str = fp.decode_codes(j[0]["code"])
                 meta = j[0]["metadata"]
                 l = meta["duration"] * 1000
                 a = meta["artist"]
@@ -103,7 +104,7 @@ def main():
                 v = meta["version"]
                 fp_codes.append({"track_id": track_id, "fp": code_str, "length": str(l), "codever": str(round(v, 2)), "artist": a, "release": r, "track": t})
         fp.ingest(fp_codes, local=True)
-        fp.local_save("disk.pkl")
+        fp.local_save("disk.idx")
 
     counter = 0
     actual_win = 0
@@ -116,8 +117,9 @@ def main():
         j = codegen(munge(file))
         if len(j):
             counter+=1
-            response = fp.query_fp(fp.decode_code_string(j[0]["code"]), rows=30, local=True, get_data=True)
-            (winner_actual, winner_original) = get_winners(fp.decode_code_string(j[0]["code"]), response, elbow=8)
+            decoded = fp.decode_codes(j[0]["code"])
+            response = fp.query_fp(decoded, rows=30, local=True, get_data=True)
+            (winner_actual, winner_original) = get_winners(decoded, response, elbow=8)
             winner_actual = winner_actual.split("-")[0]
             winner_original = winner_original.split("-")[0]
             response = fp.best_match_for_query(j[0]["code"], local=True)